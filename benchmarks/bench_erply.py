@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    Erply client benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures throughput and memory peak of the client against a local
+    fake Erply server. Run from repository root::
+
+        python -m benchmarks.bench_erply --records 20000 --latency 0.005
+"""
+from time import monotonic
+import argparse
+import tracemalloc
+
+from erply_api import Erply, ErplyAPILimitException, ErplyAuth, ErplyStats
+from benchmarks.fake_erply import FakeErplyConfig, FakeErplyServer
+
+
+def _client(server, **kwargs):
+    return Erply(ErplyAuth('bench', 'user', 'pass'), erply_api_url=server.api_url, **kwargs)
+
+
+def bench_pagination(server, args, prefetch=0, bulk=False, **kwargs):
+    with _client(server, **kwargs) as erply:
+        response = erply.getProducts(recordsOnPage=args.per_page)
+        count = sum(1 for _ in response.iter_records(prefetch=prefetch, bulk=bulk))
+    return count
+
+
+def bench_bulk(server, args):
+    with _client(server) as erply:
+        with erply.batch():
+            futures = [erply.getProducts(productID=n, recordsOnPage=1)
+                       for n in range(args.bulk_calls)]
+        return sum(1 for f in futures if f.result().total)
+
+
+def bench_csv(server, args):
+    with _client(server) as erply:
+        report = erply.getSalesReport(reportType='SALES_BY_PRODUCT')
+        return sum(1 for _ in report.iter_rows(skip_header=2, skip_footer=1, cache=False))
+
+
+def bench_quota(server, args):
+    """Records fetched until hourly limit (1002) stops the pull."""
+    count = 0
+    with _client(server) as erply:
+        try:
+            response = erply.getProducts(recordsOnPage=args.per_page)
+            for _ in response.iter_records():
+                count += 1
+        except ErplyAPILimitException:
+            pass
+    return count
+
+
+def run(name, unit, func, *args, **kwargs):
+    tracemalloc.start()
+    started = monotonic()
+    count = func(*args, **kwargs)
+    elapsed = monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<32} {:>10} {:<8} {:>8.2f}s {:>12.0f} {}/s {:>10.1f} MiB peak'.format(
+        name, count, unit, elapsed, count / elapsed if elapsed else 0, unit, peak / 1048576.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--payload', type=int, default=200, help='bytes per record')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per response')
+    parser.add_argument('--prefetch', type=int, default=8)
+    parser.add_argument('--bulk-calls', type=int, default=1000)
+    parser.add_argument('--csv-rows', type=int, default=200000)
+    parser.add_argument('--session-requests', type=int, default=25,
+                        help='requests per session key before 1054')
+    args = parser.parse_args(argv)
+
+    config = FakeErplyConfig(records_total=args.records, latency=args.latency,
+                             payload_size=args.payload, csv_rows=args.csv_rows)
+    with FakeErplyServer(config) as server:
+        run('pagination (serial)', 'records', bench_pagination, server, args)
+        run('pagination (prefetch={})'.format(args.prefetch), 'records',
+            bench_pagination, server, args, prefetch=args.prefetch)
+        run('pagination (compact, 1 page)', 'records', bench_pagination, server, args,
+            compact_records=True, max_pages=1)
+        run('pagination (lazy records)', 'records', bench_pagination, server, args,
+            lazy_records=True)
+        run('pagination (bulk pages)', 'records', bench_pagination, server, args, bulk=True)
+        run('bulk requests', 'calls', bench_bulk, server, args)
+        run('csv report', 'rows', bench_csv, server, args)
+
+        # Session expires every few requests
+        config.session_requests = args.session_requests
+        stats = ErplyStats()
+        run('pagination (session expiry)', 'records', bench_pagination, server, args,
+            observers=[stats])
+        config.session_requests = None
+
+        # Hourly limit is reached in the middle of the pull
+        server.requests = 0
+        config.quota = args.records // args.per_page // 2
+        run('pagination (quota exhausted)', 'records', bench_quota, server, args)
+        config.quota = None
+
+        print('')
+        print('{:<20} {:>6} {:>8} {:>10} {:>10} {:>10}'.format(
+            'request', 'calls', 'retries', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for request, summary in sorted(stats.summary().items()):
+            print('{:<20} {:>6} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                request, summary['count'], summary['retries'],
+                summary['p50'] * 1000, summary['p95'] * 1000, summary['p99'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
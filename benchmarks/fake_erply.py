@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    Local Erply API stand-in used by benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Simulates pagination with `recordsTotal`, session expiry (1054),
+    hourly quota exhaustion (1002), bulk requests and CSV report links
+    with configurable latency and payload sizes.
+"""
+from threading import Lock, Thread
+from time import sleep, time
+import json
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+
+class FakeErplyConfig(object):
+
+    def __init__(self, records_total=10000, latency=0.0, payload_size=200,
+                 session_requests=None, quota=None, csv_rows=100000):
+        # Number of records returned by every GET request
+        self.records_total = records_total
+        # Seconds added to every response
+        self.latency = latency
+        # Approximate size of a single record in bytes
+        self.payload_size = payload_size
+        # Session keys expire after this many requests (1054)
+        self.session_requests = session_requests
+        # Requests allowed before responding with 1002
+        self.quota = quota
+        # Number of rows in CSV reports
+        self.csv_rows = csv_rows
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type='application/json'):
+        if self.server.config.latency:
+            sleep(self.server.config.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict((k, v[0]) for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items())
+        self._send(json.dumps(self.server.handle(params)).encode('utf-8'))
+
+    def do_GET(self):
+        config = self.server.config
+        if config.latency:
+            sleep(config.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(data):
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+        write(u'Sales report;;\r\nProduct;Amount;Price\r\n'.encode('utf-8'))
+        rows = []
+        for n in range(config.csv_rows):
+            rows.append(u'"Product {}";{};{:.2f}\r\n'.format(n, n % 17, n * 0.5))
+            if len(rows) == 1000:
+                write(u''.join(rows).encode('utf-8'))
+                rows = []
+        rows.append(u'Total;;\r\n')
+        write(u''.join(rows).encode('utf-8'))
+        write(b'')
+
+
+class FakeErplyServer(ThreadingMixIn, HTTPServer):
+    """Fake Erply API server running in a background thread::
+
+        with FakeErplyServer(FakeErplyConfig(latency=0.01)) as server:
+            erply = Erply(auth, erply_api_url=server.api_url)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.config = config or FakeErplyConfig()
+        self.lock = Lock()
+        self.requests = 0
+        self._sessions = {}
+        self._session_counter = 0
+        self._thread = None
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/api/'.format(*self.server_address)
+
+    def __enter__(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def _status(self, request, error=0, total=0, in_response=0):
+        return {
+            'request': request,
+            'requestUnixTime': int(time()),
+            'responseStatus': 'error' if error else 'ok',
+            'errorCode': error,
+            'generationTime': 0.001,
+            'recordsTotal': total,
+            'recordsInResponse': in_response,
+        }
+
+    def _record(self, n):
+        padding = 'x' * max(self.config.payload_size - 60, 0)
+        return {'id': n, 'code': 'P{:08d}'.format(n), 'price': n * 0.5, 'name': padding}
+
+    def _get(self, request, params):
+        if params.get('responseType') == 'CSV':
+            link = 'http://{}:{}/reports/{}.csv'.format(self.server_address[0],
+                                                        self.server_address[1], request)
+            return {'status': self._status(request, total=1, in_response=1),
+                    'records': [{'reportLink': link}]}
+
+        per_page = int(params.get('recordsOnPage', 20))
+        page = int(params.get('pageNo', 1)) - 1
+        total = self.config.records_total
+        start = min(page * per_page, total)
+        end = min(start + per_page, total)
+        records = [self._record(n) for n in range(start, end)]
+        return {'status': self._status(request, total=total, in_response=len(records)),
+                'records': records}
+
+    def handle(self, params):
+        request = params.get('request')
+        with self.lock:
+            self.requests += 1
+            if self.config.quota is not None and self.requests > self.config.quota:
+                return {'status': self._status(request, error=1002)}
+
+            if request == 'verifyUser':
+                self._session_counter += 1
+                key = 'session{}'.format(self._session_counter)
+                self._sessions[key] = 0
+                return {'status': self._status(request, total=1, in_response=1),
+                        'records': [{'sessionKey': key, 'sessionLength': 3600}]}
+
+            key = params.get('sessionKey')
+            if key not in self._sessions:
+                return {'status': self._status(request, error=1054)}
+            self._sessions[key] += 1
+            if self.config.session_requests and self._sessions[key] > self.config.session_requests:
+                del self._sessions[key]
+                return {'status': self._status(request, error=1054)}
+
+        if 'requests' in params:
+            items = []
+            for item in json.loads(params['requests']):
+                data = self._get(item['requestName'], item)
+                data['status']['requestName'] = item['requestName']
+                data['status']['requestID'] = item.get('requestID')
+                items.append(data)
+            return {'status': self._status(None), 'requests': items}
+
+        return self._get(request, params)
@@ -8,11 +8,37 @@
     :copyright: (c) 2014-2016 by Priit Laes
     :license: BSD, see LICENSE for details.
 """
-from contextlib import closing
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed,
+    TimeoutError as FutureTimeoutError,
+)
+from contextlib import closing, contextmanager
 from datetime import datetime
-from time import sleep
+from tempfile import SpooledTemporaryFile
+from time import monotonic, sleep, time
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import atexit
+import codecs
+import contextvars
 import csv
+import importlib
+import io
+import json
+import os
+import queue
+import random
+import re
 import requests
+import sqlite3
+import sys
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 import logging
 
@@ -27,6 +53,22 @@ except ImportError:
 logger = logging.getLogger(__name__)
 logger.addHandler(NullHandler())
 
+# Optional dependencies are imported on first use, see _optional_module
+_optional_modules = {}
+
+
+def _optional_module(name):
+    """Import optional dependency `name`, return None if it is not installed."""
+    try:
+        return _optional_modules[name]
+    except KeyError:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            module = None
+        return _optional_modules.setdefault(name, module)
+
+
 class ErplyException(Exception):
     pass
 
@@ -38,11 +80,708 @@ class ErplyAPILimitException(ErplyException):
     time until API accepts requests again.
     """
     def __init__(self, server_time):
+        super(ErplyAPILimitException, self).__init__(server_time)
         self.server_time = server_time
 
 class ErplyPermissionException(ErplyException):
     """No viewing rights for this item."""
 
+class ErplyTimeoutException(ErplyException):
+    """Raised when deadline of the call has been exceeded."""
+
+
+class ErplyDeadline(object):
+    """Point in time by which call has to complete, including its retries,
+    re-authentication and fetching of following pages.
+
+    :param seconds: Time from now until the deadline.
+    """
+
+    def __init__(self, seconds):
+        self.expires = monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - monotonic()
+
+
+class ErplyRetry(object):
+    """Retry policy for connection errors, timeouts and 5xx responses.
+
+    Delays grow exponentially from `backoff` up to `max_backoff` seconds,
+    with full jitter. Non-idempotent calls (eg. `saveProduct`) are only
+    retried when connection could not be established at all (connection
+    refused or timed out), so the request was never sent. Other errors
+    (eg. invalid URL) are not retried.
+
+    :param total: Maximum number of retries.
+    """
+
+    def __init__(self, total=3, backoff=0.5, max_backoff=10.0, jitter=True,
+                 statuses=(500, 502, 503, 504)):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number `attempt` (starting from 0)."""
+        delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+# Options of the call currently in progress, see Erply._call_options
+_call_timeout = contextvars.ContextVar('erply_call_timeout', default=None)
+_call_deadline = contextvars.ContextVar('erply_call_deadline', default=None)
+
+
+@contextmanager
+def _call_options(timeout=None, deadline=None):
+    """Set timeout and deadline for calls made within the block."""
+    if deadline is not None and not isinstance(deadline, ErplyDeadline):
+        deadline = ErplyDeadline(deadline)
+    current = _call_deadline.get()
+    if current is not None and (deadline is None or current.expires < deadline.expires):
+        # Nested calls can not extend the deadline
+        deadline = current
+
+    timeout_token = _call_timeout.set(timeout if timeout is not None else _call_timeout.get())
+    deadline_token = _call_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _call_deadline.reset(deadline_token)
+        _call_timeout.reset(timeout_token)
+
+
+# Duration and size in bytes of the last response received in this context
+_last_response = contextvars.ContextVar('erply_last_response', default=None)
+
+
+def _pop_call_options(kwargs):
+    return kwargs.pop('_timeout', None), kwargs.pop('_deadline', None)
+
+
+def _request_not_sent(error):
+    """Whether connection `error` happened before request was sent."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # Failed connection is wrapped in urllib3 MaxRetryError by requests
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+def _status_error(status):
+    """Create exception matching the failed Erply response `status`."""
+    error = status.get('errorCode')
+
+    if error == 1060:
+        # No viewing rights for this item
+        logger.info('Permission denied for this resource')
+        return ErplyPermissionException()
+
+    field = status.get('errorField')
+    if field:
+        return ErplyException('Erply error: {}, field: {}'.format(error, field))
+
+    return ErplyException('Erply error: {}'.format(error))
+
+class ErplyQuota(object):
+    """Client-side hourly request budget, shared between processes.
+
+    Budget is tracked per client code in SQLite database, so processes on
+    the same host using the same `path` draw from a single budget. Lower
+    priority calls can only use part of the hourly budget, leaving the
+    rest for higher priority (eg. interactive) calls.
+
+    :param path: SQLite database file, by default budget is only shared
+        within the current process and the quota can not be pickled.
+    :param limit: Number of requests allowed per hour.
+    :param reserve: Mapping of priority to share of the hourly budget that
+        is kept reserved for higher priority calls.
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    def __init__(self, path=':memory:', limit=1000, reserve=None, timeout=30):
+        self.path = path
+        self.limit = limit
+        self.reserve = reserve or {
+            self.PRIORITY_HIGH: 0.0,
+            self.PRIORITY_NORMAL: 0.1,
+            self.PRIORITY_LOW: 0.3,
+        }
+        self.timeout = timeout
+        self._connect()
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS erply_quota ('
+                         'code TEXT PRIMARY KEY, hour INTEGER, used INTEGER)')
+
+    def __getstate__(self):
+        # Database is reopened when passed to another process, in-memory
+        # database would silently give each process its own budget.
+        if self.path in (':memory:', ''):
+            raise TypeError('In-memory ErplyQuota can not be shared between processes, '
+                            'pass database file path instead')
+        return dict((k, v) for k, v in self.__dict__.items() if k not in ('_lock', '_db'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def _update(self, code, update):
+        now = time()
+        hour = int(now // 3600)
+        with self._lock:
+            # Take write lock right away to serialize concurrent processes
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute('SELECT hour, used FROM erply_quota WHERE code = ?',
+                                       (code,)).fetchone()
+                used = row[1] if row and row[0] == hour else 0
+                new_used = update(used)
+                if new_used != used:
+                    self._db.execute('INSERT OR REPLACE INTO erply_quota VALUES (?, ?, ?)',
+                                     (code, hour, new_used))
+            finally:
+                self._db.execute('COMMIT')
+        return now, hour, used, new_used
+
+    def acquire(self, code, priority=PRIORITY_NORMAL, cost=1):
+        """Reserve `cost` requests from the hourly budget of `code`.
+
+        Returns zero when requests were reserved, otherwise number of
+        seconds until the budget is renewed.
+        """
+        allowed = self.limit - int(self.limit * self.reserve.get(priority, 0))
+        now, hour, used, new_used = self._update(
+            code, lambda used: used + cost if used + cost <= allowed else used)
+        if new_used != used:
+            return 0
+        return (hour + 1) * 3600 - now + 1
+
+    def remaining(self, code):
+        """Remaining requests in the current hour for `code`."""
+        _, _, used, _ = self._update(code, lambda used: used)
+        return max(self.limit - used, 0)
+
+    def exhaust(self, code):
+        """Mark budget of `code` used up until the next hour."""
+        self._update(code, lambda used: max(used, self.limit))
+
+    def close(self):
+        self._db.close()
+
+
+class ErplySessionStore(object):
+    """In-memory session key store, shared by clients within a process.
+
+    Sessions are stored as `(session_key, expires, refresh_at)` tuples of
+    unix timestamps. Subclasses persist them across processes.
+
+    :param refresh_margin: Seconds before expiry when session is refreshed
+        in the background.
+    """
+
+    def __init__(self, refresh_margin=60):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.RLock()
+        self._sessions = {}
+
+    def get(self, key):
+        return self._sessions.get(key)
+
+    def set(self, key, session):
+        self._sessions[key] = tuple(session)
+
+    def delete(self, key, session_key):
+        """Remove session unless it has already been replaced."""
+        with self._lock:
+            session = self.get(key)
+            if session and session[0] == session_key:
+                self._sessions.pop(key, None)
+
+    @contextmanager
+    def lock(self, key):
+        """Ensure only one client authenticates at a time."""
+        with self._lock:
+            yield
+
+
+class ErplyFileSessionStore(ErplySessionStore):
+    """Session key store persisted to a JSON file.
+
+    Processes are serialized with a lock file next to `path`.
+    """
+
+    # Lock files older than this are considered stale
+    lock_timeout = 60
+
+    def __init__(self, path, refresh_margin=60):
+        super(ErplyFileSessionStore, self).__init__(refresh_margin)
+        self.path = path
+        self._local = threading.local()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, sessions):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(sessions, f)
+        os.replace(tmp, self.path)
+
+    def get(self, key):
+        session = self._read().get(key)
+        return tuple(session) if session else None
+
+    def set(self, key, session):
+        with self.lock(key):
+            sessions = self._read()
+            sessions[key] = list(session)
+            self._write(sessions)
+
+    def delete(self, key, session_key):
+        with self.lock(key):
+            sessions = self._read()
+            if sessions.get(key, [None])[0] == session_key:
+                sessions.pop(key)
+                self._write(sessions)
+
+    @contextmanager
+    def lock(self, key):
+        lock_path = self.path + '.lock'
+        with self._lock:
+            if getattr(self._local, 'held', False):
+                # Re-entered from within the same thread
+                yield
+                return
+            while True:
+                try:
+                    fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                    break
+                except OSError:
+                    try:
+                        if time() - os.path.getmtime(lock_path) > self.lock_timeout:
+                            os.remove(lock_path)
+                    except OSError:
+                        pass
+                    sleep(0.05)
+            self._local.held = True
+            try:
+                yield
+            finally:
+                self._local.held = False
+                os.close(fd)
+                os.remove(lock_path)
+
+
+class ErplySQLiteSessionStore(ErplySessionStore):
+    """Session key store persisted to SQLite database."""
+
+    def __init__(self, path, refresh_margin=60, timeout=30):
+        super(ErplySQLiteSessionStore, self).__init__(refresh_margin)
+        self._depth = 0
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS erply_sessions ('
+                         'key TEXT PRIMARY KEY, session_key TEXT, '
+                         'expires REAL, refresh_at REAL)')
+
+    def get(self, key):
+        with self._lock:
+            return self._db.execute('SELECT session_key, expires, refresh_at '
+                                    'FROM erply_sessions WHERE key = ?', (key,)).fetchone()
+
+    def set(self, key, session):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO erply_sessions VALUES (?, ?, ?, ?)',
+                             (key,) + tuple(session))
+
+    def delete(self, key, session_key):
+        with self._lock:
+            self._db.execute('DELETE FROM erply_sessions WHERE key = ? AND session_key = ?',
+                             (key, session_key))
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            # Write transaction is held while authenticating, which blocks
+            # other processes from authenticating at the same time.
+            if not self._depth:
+                self._db.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self._db.execute('COMMIT')
+
+    def close(self):
+        self._db.close()
+
+
+class ErplyMemoryCacheBackend(object):
+    """Size-bounded in-memory LRU storage for :class:`ErplyCache`."""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, request, expires, value):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, request=None):
+        with self._lock:
+            if request is None:
+                self._entries.clear()
+                return
+            prefix = request + '|'
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+
+class ErplySQLiteCacheBackend(object):
+    """Size-bounded on-disk LRU storage for :class:`ErplyCache`."""
+
+    def __init__(self, path, max_size=10000, timeout=30):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS erply_cache ('
+                         'key TEXT PRIMARY KEY, request TEXT, expires REAL, '
+                         'accessed INTEGER, value TEXT)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT expires, value FROM erply_cache WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE erply_cache SET accessed = ('
+                                 'SELECT MAX(accessed) + 1 FROM erply_cache) WHERE key = ?',
+                                 (key,))
+            return row
+
+    def set(self, key, request, expires, value):
+        with self._lock:
+            # Access order is tracked with a counter, clock might be too coarse
+            self._db.execute('INSERT OR REPLACE INTO erply_cache VALUES (?, ?, ?, ('
+                             'SELECT COALESCE(MAX(accessed), 0) + 1 FROM erply_cache), ?)',
+                             (key, request, expires, value))
+            self._db.execute('DELETE FROM erply_cache WHERE key IN ('
+                             'SELECT key FROM erply_cache ORDER BY accessed DESC '
+                             'LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def delete(self, request=None):
+        with self._lock:
+            if request is None:
+                self._db.execute('DELETE FROM erply_cache')
+            else:
+                self._db.execute('DELETE FROM erply_cache WHERE request = ?', (request,))
+
+    def close(self):
+        self._db.close()
+
+
+class ErplyCache(object):
+    """Opt-in cache for responses of read-mostly GET requests.
+
+    Only requests with a configured time-to-live are cached. Entries are
+    keyed by request, client code, page number and normalised parameters,
+    and are dropped when a related write request (see `invalidates`)
+    succeeds.
+
+    :param ttls: Mapping of request name to time-to-live in seconds.
+    :param backend: Storage backend, in-memory LRU by default.
+    :param invalidates: Mapping of write request name to GET requests
+        whose cached responses it invalidates.
+    """
+
+    DEFAULT_TTLS = {
+        'getAddressTypes': 3600,
+        'getCustomerGroups': 3600,
+        'getProductCategories': 3600,
+        'getProductGroups': 3600,
+        'getProductUnits': 3600,
+        'getWarehouses': 3600,
+    }
+    DEFAULT_INVALIDATES = {
+        'saveProduct': ('getProducts', 'getProductCategories', 'getProductGroups',
+                        'getProductPrices', 'getProductStock', 'getProductUnits'),
+    }
+
+    def __init__(self, ttls=None, backend=None, invalidates=None):
+        self.ttls = self.DEFAULT_TTLS if ttls is None else ttls
+        self.backend = backend or ErplyMemoryCacheBackend()
+        self.invalidates = self.DEFAULT_INVALIDATES if invalidates is None else invalidates
+        # Cache can be shared by threads of the client
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(request, code, params):
+        params = sorted((k, str(v)) for k, v in params.items())
+        return '{}|{}|{}'.format(request, code, json.dumps(params))
+
+    def get(self, request, code, params):
+        """Return cached response data or `None`."""
+        if request not in self.ttls:
+            return None
+        entry = self.backend.get(self.key(request, code, params))
+        hit = entry is not None and entry[0] > time()
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(entry[1]) if hit else None
+
+    def set(self, request, code, params, data):
+        ttl = self.ttls.get(request)
+        if ttl:
+            value = data.content if isinstance(data, _LazyPayload) else json.dumps(data)
+            self.backend.set(self.key(request, code, params), request,
+                             time() + ttl, value)
+
+    def invalidate(self, request=None):
+        """Drop cached responses of `request`, or everything."""
+        self.backend.delete(request)
+
+    def invalidate_for(self, request):
+        """Drop cached responses affected by write `request`."""
+        for name in self.invalidates.get(request, ()):
+            self.invalidate(name)
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.0,
+        }
+
+
+class ErplyJSONCodec(object):
+    """JSON codec based on standard library :mod:`json` module."""
+
+    def loads(self, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return json.loads(content)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+
+class ErplyOrjsonCodec(object):
+    """Faster JSON codec, requires `orjson`."""
+
+    def __init__(self):
+        if _optional_module('orjson') is None:
+            raise ImportError('ErplyOrjsonCodec requires orjson')
+
+    def loads(self, content):
+        return _optional_module('orjson').loads(content)
+
+    def dumps(self, obj):
+        return _optional_module('orjson').dumps(obj).decode('utf-8')
+
+
+def default_codec():
+    """Return fastest available JSON codec."""
+    return ErplyOrjsonCodec() if _optional_module('orjson') is not None else ErplyJSONCodec()
+
+
+_STATUS_PREFIX = re.compile(r'\s*\{\s*"status"\s*:\s*')
+
+
+class _LazyPayload(Mapping):
+    """Erply response where only `status` is decoded up front.
+
+    Erply responses start with the `status` object, which is decoded
+    without touching the rest of the response. Everything else (usually
+    large `records` list) is decoded on first access.
+    """
+
+    def __init__(self, content, codec):
+        self.content = content.decode('utf-8') if isinstance(content, bytes) else content
+        self._codec = codec
+        self._data = None
+
+        match = _STATUS_PREFIX.match(self.content)
+        if match:
+            try:
+                self.status, _ = json.JSONDecoder().raw_decode(self.content, match.end())
+            except ValueError:
+                match = None
+        if not match:
+            self.status = self._decoded.get('status')
+
+    @property
+    def _decoded(self):
+        if self._data is None:
+            self._data = self._codec.loads(self.content)
+        return self._data
+
+    def __getitem__(self, key):
+        if key == 'status' and self.status is not None:
+            return self.status
+        return self._decoded[key]
+
+    def __iter__(self):
+        return iter(self._decoded)
+
+    def __len__(self):
+        return len(self._decoded)
+
+    def lazy_records(self):
+        return _LazyRecords(self)
+
+
+class _LazyRecords(object):
+    """Placeholder for records of a page which have not been decoded yet."""
+
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def load(self):
+        return self.payload.get('records')
+
+
+def _payload_records(data):
+    if isinstance(data, _LazyPayload):
+        return data.lazy_records()
+    return data.get('records')
+
+
+class ErplyRequestEvent(object):
+    """Instrumentation data of a single API call, see :class:`ErplyObserver`.
+
+    `page` is zero-based page index, `duration` is wall time in seconds,
+    `generation_time` is Erply's own processing time from response status,
+    `error` is Erply error code or HTTP status code of failed call,
+    `batch_size` is number of requests in bulk call and `quota_remaining`
+    is estimate from client-side quota.
+    """
+
+    __slots__ = ('request', 'page', 'duration', 'bytes_sent', 'bytes_received',
+                 'generation_time', 'error', 'batch_size', 'quota_remaining')
+
+    def __init__(self, request, page=0, duration=0.0, bytes_sent=0, bytes_received=0,
+                 generation_time=None, error=None, batch_size=None, quota_remaining=None):
+        self.request = request
+        self.page = page
+        self.duration = duration
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.generation_time = generation_time
+        self.error = error
+        self.batch_size = batch_size
+        self.quota_remaining = quota_remaining
+
+
+class ErplyObserver(object):
+    """Receives instrumentation events from :class:`Erply` clients.
+
+    Subclass and override methods of interest, by default they do nothing.
+    """
+
+    def request(self, event):
+        """Called after each API call with :class:`ErplyRequestEvent`."""
+
+    def retry(self, request, reason):
+        """Called when call is retried, `reason` is eg. `'reauth'`."""
+
+    def limit_sleep(self, request, seconds):
+        """Called before sleeping until API limit is renewed."""
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of sorted `values`."""
+    if not values:
+        return None
+    rank = int(-(-len(values) * percent // 100))
+    return values[max(rank, 1) - 1]
+
+
+class ErplyStats(ErplyObserver):
+    """In-process aggregator of latencies and counters per request type.
+
+    :param max_samples: Number of most recent latencies kept per request.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._requests = {}
+
+    def _stats(self, request):
+        stats = self._requests.get(request)
+        if stats is None:
+            stats = self._requests[request] = {
+                'count': 0, 'errors': 0, 'retries': 0, 'sleeps': 0,
+                'bytes_sent': 0, 'bytes_received': 0,
+                'durations': deque(maxlen=self.max_samples),
+            }
+        return stats
+
+    def request(self, event):
+        with self._lock:
+            stats = self._stats(event.request)
+            stats['count'] += 1
+            stats['errors'] += 1 if event.error else 0
+            stats['bytes_sent'] += event.bytes_sent
+            stats['bytes_received'] += event.bytes_received
+            stats['durations'].append(event.duration)
+
+    def retry(self, request, reason):
+        with self._lock:
+            self._stats(request)['retries'] += 1
+
+    def limit_sleep(self, request, seconds):
+        with self._lock:
+            self._stats(request)['sleeps'] += 1
+
+    def summary(self):
+        """Return counters and p50/p95/p99 latency per request type."""
+        result = {}
+        with self._lock:
+            for request, stats in self._requests.items():
+                durations = sorted(stats['durations'])
+                summary = dict((k, v) for k, v in stats.items() if k != 'durations')
+                for percent in (50, 95, 99):
+                    summary['p{}'.format(percent)] = _percentile(durations, percent)
+                result[request] = summary
+        return result
+
+
 class ErplyAuth(object):
 
     def __init__(self, code, username, password):
@@ -55,6 +794,55 @@ class ErplyAuth(object):
         return {'username': self.username,
                 'password': self.password}
 
+class ErplyTransport(object):
+    """Pooled keep-alive HTTP transport used by :class:`Erply` clients.
+
+    Connections to `{code}.erply.com` are kept alive and reused between
+    calls, so only the first request pays for the TCP and TLS handshake.
+    A single transport can be shared by several :class:`Erply` instances.
+
+    :param pool_connections: Number of per-host connection pools to cache.
+    :param pool_maxsize: Maximum number of connections kept per host.
+    :param pool_block: Whether to block when no free connection is available
+        instead of opening a new (non-pooled) connection.
+    :param keep_alive: When False, connections are closed after each request.
+    :param session: Optional pre-configured :class:`requests.Session`.
+    :param adapter: Optional transport adapter mounted for http and https.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, session=None, adapter=None):
+        self.session = session or requests.Session()
+
+        # Only replace adapters on sessions we have created ourselves, or
+        # when explicitly asked to.
+        if adapter is None and session is None:
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=pool_block)
+        if adapter is not None:
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class Erply(object):
 
     ERPLY_GET = (
@@ -83,9 +871,75 @@ class Erply(object):
     ERPLY_CSV = ('getProductStockCSV', 'getSalesReport')
     ERPLY_POST = ('saveProduct',)
 
-    def __init__(self, auth, erply_api_url=None, wait_on_limit=False):
+    # Maximum number of requests in a single bulk call
+    ERPLY_BULK_MAX = 100
+
+    # Maximum number of records on a page per request, used by
+    # `recordsOnPage='auto'`. Requests not listed use the default.
+    ERPLY_PAGE_SIZE_MAX = {}
+    ERPLY_PAGE_SIZE_DEFAULT = 1000
+
+    def __init__(self, auth, erply_api_url=None, wait_on_limit=False,
+                 transport=None, quota=None, priority=ErplyQuota.PRIORITY_NORMAL,
+                 session_store=None, cache=None, compact_records=False, max_pages=None,
+                 codec=None, lazy_records=False, observers=None,
+                 timeout=(10, 300), retry=None):
         self.auth = auth
         self._key = None
+        # Guards session key, so only one thread authenticates at a time
+        self._session_lock = threading.RLock()
+        # Identical GET requests in progress, see `_single_flight`
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # Page sizes lowered after server returned smaller pages than requested
+        self._page_size_limits = {}
+
+        # Default timeout of HTTP requests, either number of seconds or
+        # `(connect, read)` tuple. Can be overridden per call with
+        # `_timeout`, while `_deadline` limits the total time of the call.
+        self.timeout = timeout
+        # Retry policy (ErplyRetry) for connection errors and 5xx responses
+        self.retry = retry if retry is not None else ErplyRetry()
+
+        # Instrumentation, list of ErplyObserver instances
+        self.observers = list(observers or [])
+
+        # JSON codec used for bulk requests and responses. With
+        # `lazy_records` only status of response is decoded right away,
+        # records are decoded when accessed.
+        self.codec = codec or default_codec()
+        self.lazy_records = lazy_records
+
+        # Response record storage: `compact_records` stores pages as
+        # ErplyRecordPage instead of lists of dicts, `max_pages` limits the
+        # number of pages kept in memory per response (evicted pages are
+        # fetched again when accessed).
+        self.compact_records = compact_records
+        self.max_pages = max_pages
+
+        # Optional response cache (ErplyCache) for GET requests
+        self.cache = cache
+
+        # Optional session key cache (ErplySessionStore) shared with other
+        # clients and processes. Keys are refreshed before they expire.
+        self.session_store = session_store
+        self._key_refresh_at = None
+        self._key_expires = None
+        self._refresh_thread = None
+
+        # Optional client-side request budget (ErplyQuota), usually shared
+        # between clients. Priority determines the share of the budget
+        # requests from this client are allowed to use.
+        self.quota = quota
+        self.priority = priority
+
+        # HTTP transport, can be shared between multiple Erply instances.
+        # Transport created here is owned (and closed) by this instance.
+        self._owns_transport = transport is None
+        self.transport = transport or ErplyTransport()
+
+        # Per-thread state, eg. currently active batch
+        self._local = threading.local()
 
         # Whether to wait for next hour when API limit has been met.
         # When False, ErplyAPILimitException will be raised, otherwise
@@ -95,21 +949,113 @@ class Erply(object):
         # User-specified Erply API url
         self.erply_api_url = erply_api_url
 
+    def close(self):
+        """Release pooled connections unless the transport is shared."""
+        if self._owns_transport:
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @property
     def _payload(self):
         return {'clientCode': self.auth.code}
 
     @property
     def session(self):
-        def authenticate():
-            response = self.verifyUser(**self.auth.data)
-            if response.error:
-                logger.exception("Authentication failed with code {}".format(response.error))
-                raise ValueError
-            key = response.fetchone().get('sessionKey', None)
-            self._key = key
-            return key
-        return self._key if self._key else authenticate()
+        def expired():
+            return not self._key or (self._key_expires or float('inf')) <= time()
+
+        if expired():
+            with self._session_lock:
+                # Another thread might have authenticated in the meantime
+                if not expired():
+                    pass
+                elif self.session_store is None:
+                    self._key = self._session_key(self._verify_user())
+                else:
+                    self._use_session(self._load_session())
+        key = self._key
+        if (self._key_refresh_at or float('inf')) <= time():
+            self._refresh_in_background()
+        return key
+
+    @property
+    def _session_id(self):
+        return '{}:{}'.format(self.auth.code, self.auth.username)
+
+    def _use_session(self, session):
+        with self._session_lock:
+            self._key, self._key_expires, self._key_refresh_at = session
+
+    def _authenticate(self):
+        return self._new_session(self._verify_user())
+
+    def _verify_user(self):
+        # Called directly, so authentication is never added to current batch
+        return self.handle_get('verifyUser', 0, **self.auth.data)
+
+    def _new_session(self, response):
+        """Store session from `verifyUser` response in the session store."""
+        key = self._session_key(response)
+        now = time()
+        length = int(response.fetchone().get('sessionLength') or 3600)
+        margin = min(self.session_store.refresh_margin, length / 2.0)
+        session = (key, now + length, now + length - margin)
+        self.session_store.set(self._session_id, session)
+        return session
+
+    def _load_session(self):
+        store = self.session_store
+        session = store.get(self._session_id)
+        if session and session[1] > time():
+            return session
+        with store.lock(self._session_id):
+            # Another client might have authenticated in the meantime
+            session = store.get(self._session_id)
+            if session and session[1] > time():
+                return session
+            return self._authenticate()
+
+    def _refresh_session(self):
+        store = self.session_store
+        try:
+            with store.lock(self._session_id):
+                session = store.get(self._session_id)
+                if not session or session[2] <= time():
+                    session = self._authenticate()
+            # Store lock is released first, `_session_lock` is always taken
+            # before it
+            self._use_session(session)
+        except Exception:
+            logger.exception('Refreshing Erply session failed')
+
+    def _refresh_in_background(self):
+        with self._session_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_session)
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _expire_session(self, key=None):
+        """Forget session `key`, or current session when `key` is not given."""
+        with self._session_lock:
+            if key is not None and key != self._key:
+                # Another thread has already re-authenticated
+                return
+            expired, self._key = self._key, None
+        if self.session_store is not None and expired:
+            self.session_store.delete(self._session_id, expired)
+
+    def _session_key(self, response):
+        if response.error:
+            logger.exception("Authentication failed with code {}".format(response.error))
+            raise ValueError
+        return response.fetchone().get('sessionKey', None)
 
     @property
     def payload(self):
@@ -120,7 +1066,7 @@ class Erply(object):
         return self.erply_api_url or \
             'https://{}.erply.com/api/'.format(self.auth.code)
 
-    def _erply_query(self, data, _initial_response=None):
+    def _erply_query(self, data, _initial_response=None, _batch_size=None, _idempotent=None):
         """Send request to Erply API and parse response.
 
         Returns two-tuple containing: `retry` and `data` values:
@@ -130,90 +1076,307 @@ class Erply(object):
             - `data` - dictionary of original json-encoded response.
         """
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if _idempotent is None:
+            _idempotent = self._is_idempotent(data)
 
         logger.debug('Erply request %s', data.get('request'))
-        resp = requests.post(self.api_url, data=data, headers=headers)
-
-        if resp.status_code != requests.codes.ok:
-            raise ValueError('Request failed with error {}'.format(resp.status_code))
+        self._reserve_quota()
+        attempt = 0
+        while True:
+            timeout = self._request_timeout()
+            started = monotonic()
+            try:
+                resp, error = self.transport.post(self.api_url, data=data, headers=headers,
+                                                  timeout=timeout), None
+            except requests.exceptions.RequestException as e:
+                resp, error = None, e
+            delay = self._retry_delay(data.get('request'), resp, error, attempt, _idempotent)
+            if delay is None:
+                break
+            sleep(delay)
+            attempt += 1
+
+        session_key = data.get('sessionKey')
+        data = self._decode_response(resp, data, monotonic() - started, _batch_size)
+        wait = self._check_status(data, session_key)
+        if wait is None:
+            return False, data
 
-        data = resp.json()
+        if wait:
+            sleep(wait)
+        return True, None
+
+    def _is_idempotent(self, data):
+        return data.get('request') in self.ERPLY_GET or data.get('responseType') == 'CSV'
+
+    def _request_timeout(self):
+        """Timeout for the next HTTP request, limited by call deadline."""
+        timeout = _call_timeout.get()
+        if timeout is None:
+            timeout = self.timeout
+        deadline = _call_deadline.get()
+        if deadline is None:
+            return timeout
+
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise ErplyTimeoutException('Deadline exceeded')
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+    def _retry_delay(self, request, resp, error, attempt, idempotent):
+        """Return seconds to wait before retrying failed HTTP request.
+
+        Returns `None` when request should not be retried, re-raises
+        connection `error` when it can not be retried.
+        """
+        if error is None and resp.status_code not in self.retry.statuses:
+            return None
+
+        if error is None:
+            retryable = idempotent
+        elif isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            retryable = idempotent or _request_not_sent(error)
+        else:
+            # Invalid URL, headers etc. fail the same way again
+            retryable = False
+        delay = self.retry.delay(attempt) if attempt < self.retry.total else None
+        deadline = _call_deadline.get()
+        if delay is not None and deadline is not None and delay >= deadline.remaining():
+            delay = None
+
+        if not retryable or delay is None:
+            if error is not None:
+                raise error
+            return None
+
+        logger.info('Request %s failed (%s), retrying in %.2f seconds',
+                    request, error or resp.status_code, delay)
+        self._notify('retry', request, 'connection' if error is not None else 'status')
+        return delay
+
+    def _reserve_quota(self):
+        while True:
+            wait = self._quota_wait()
+            if not wait:
+                return
+            sleep(wait)
+
+    def _quota_wait(self):
+        """Reserve request from client-side quota.
+
+        Returns number of seconds to wait before trying again, or zero
+        when request can be sent.
+        """
+        if self.quota is None:
+            return 0
+        wait = self.quota.acquire(self.auth.code, self.priority)
+        if wait:
+            if not self._can_wait(wait):
+                raise ErplyAPILimitException(datetime.now())
+            logger.info('Client-side API quota used up, sleeping for %d seconds' % wait)
+            self._notify('limit_sleep', None, wait)
+        return wait
+
+    def _can_wait(self, seconds):
+        """Whether call is allowed to wait `seconds` for API limit."""
+        deadline = _call_deadline.get()
+        return self.wait_on_limit and (deadline is None or seconds < deadline.remaining())
+
+    def _decode_response(self, resp, request_data=None, duration=0.0, batch_size=None):
+        data = None
+        try:
+            if resp.status_code != requests.codes.ok:
+                raise ValueError('Request failed with error {}'.format(resp.status_code))
+
+            _last_response.set((duration, len(resp.content or b'')))
+            if self.lazy_records:
+                data = _LazyPayload(resp.content, self.codec)
+            else:
+                data = self.codec.loads(resp.content)
+            if not data.get('status', {}):
+                raise ValueError('Malformed response')
+            return data
+        finally:
+            if self.observers and request_data is not None:
+                self._report_request(request_data, resp, data, duration, batch_size)
+
+    def _report_request(self, request_data, resp, data, duration, batch_size):
+        status = data.get('status', {}) if data is not None else {}
+        event = ErplyRequestEvent(
+            request_data.get('request') or ('bulk' if batch_size else None),
+            page=int(request_data.get('pageNo', 1)) - 1,
+            duration=duration,
+            bytes_sent=len(urlencode(request_data)),
+            bytes_received=len(resp.content or b''),
+            generation_time=status.get('generationTime'),
+            error=status.get('errorCode') or (
+                resp.status_code if resp.status_code != requests.codes.ok else None),
+            batch_size=batch_size,
+            quota_remaining=self.quota.remaining(self.auth.code) if self.quota else None)
+        self._notify('request', event)
+
+    def _notify(self, method, *args):
+        for observer in self.observers:
+            try:
+                getattr(observer, method)(*args)
+            except Exception:
+                logger.exception('Erply observer %r failed', observer)
+
+    def _check_status(self, data, session_key=None):
+        """Check status of decoded Erply response.
+
+        Returns `None` when request succeeded, otherwise amount of seconds
+        caller has to wait before retrying the request (zero when request
+        can be retried immediately). `session_key` is the key request was
+        sent with.
+        """
         status = data.get('status', {})
-
-        if not status:
-            raise ValueError('Malformed response')
-
         error = status.get('errorCode')
 
         if error == 0:
-            return False, data
+            return None
 
         elif error == 1002:
             server_time = datetime.fromtimestamp(status.get('requestUnixTime'))
+            if self.quota is not None:
+                self.quota.exhaust(self.auth.code)
+
+            # Calculate time to sleep until next hour
+            sleep_time = (60 * (60 - server_time.minute)) + 1
 
-            if not self.wait_on_limit:
+            if not self._can_wait(sleep_time):
                 raise ErplyAPILimitException(server_time)
 
-            sleep_time = (60 * (60 - server_time.minute)) + 1
             logger.info('Hourly API limit exceeded, sleeping for %d seconds' % sleep_time)
-
-            # Calculate time to sleep until next hour
-            sleep(sleep_time)
-            return True, None
+            self._notify('limit_sleep', status.get('request'), sleep_time)
+            return sleep_time
 
         elif error == 1054:
-            self._key = None
+            self._expire_session(session_key)
             logger.info('Retrying API call...')
-            return True, None
+            self._notify('retry', status.get('request'), 'reauth')
+            return 0
 
-        elif error == 1060:
-            # No viewing rights for this item
-            logger.info('Permission denied for this resource')
-            raise ErplyPermissionException()
+        raise _status_error(status)
 
-        field = status.get('errorField')
-        if field:
-            raise ErplyException('Erply error: {}, field: {}'.format(error, field))
+    def _cache_get(self, request, params):
+        if self.cache is None:
+            return None
+        return self.cache.get(request, self.auth.code, params)
 
-        raise ErplyException('Erply error: {}'.format(error))
+    def _cache_set(self, request, params, data):
+        if self.cache is not None:
+            self.cache.set(request, self.auth.code, params, data)
 
     def handle_csv(self, request, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return self.handle_csv(request, *args, **kwargs)
+
         data = dict(request=request.replace('CSV', ''), responseType='CSV')
         data.update(self.payload)
         data.update(**kwargs)
 
         retry, parsed_data = self._erply_query(data)
         if retry:
-            return getattr(self, request)(*args, **kwargs)
+            return self.handle_csv(request, *args, **kwargs)
 
         return ErplyCSVResponse(self, parsed_data)
 
 
     def handle_get(self, request, _page=None, _response=None, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return self.handle_get(request, _page, _response, *args, **kwargs)
+
         _is_bulk = kwargs.pop('_is_bulk', False)
-        data = kwargs.copy()
-        if _page:
-            data['pageNo'] = _page + 1
+        data = self._page_params(request, kwargs, _page)
         if _is_bulk:
             data.update(requestName=request)
             return data
 
-        data.update(request=request)
-        data.update(self.payload if request != 'verifyUser' else self._payload)
+        parsed_data = self._cache_get(request, data)
+        if parsed_data is None:
+            params = data.copy()
+            data.update(request=request)
+            data.update(self.payload if request != 'verifyUser' else self._payload)
 
-        retry, parsed_data = self._erply_query(data)
+            retry, parsed_data = self._single_flight(request, params, self._erply_query, data)
 
-        # Retry request in case of token expiration
-        if retry:
-            return getattr(self, request)(_page=_page, _response=_response, *args, **kwargs)
+            # Retry request in case of token expiration
+            if retry:
+                return self.handle_get(request, _page, _response, *args, **kwargs)
+            self._cache_set(request, params, parsed_data)
 
+        # Size of the page is checked before adding it to the response
+        response = ErplyResponse(self, parsed_data, request, _page, *args, **kwargs)
         if _response:
-            _response.populate_page(parsed_data.get('records'), _page)
+            _response.populate_page(_payload_records(parsed_data), _page)
+        return response
 
-        return ErplyResponse(self, parsed_data, request, _page, *args, **kwargs)
 
+    def _single_flight(self, request, params, query, *args):
+        """Run `query`, unless identical request is already in progress in
+        another thread, in which case its result is shared.
+        """
+        key = (request, tuple(sorted((k, str(v)) for k, v in params.items())))
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+
+        if not leader:
+            deadline = _call_deadline.get()
+            try:
+                return future.result(deadline.remaining() if deadline is not None else None)
+            except FutureTimeoutError:
+                raise ErplyTimeoutException('Deadline exceeded')
+
+        try:
+            result = query(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def page_size_max(self, request):
+        """Maximum number of records on a page of `request`."""
+        return self._page_size_limits.get(request) or \
+            self.ERPLY_PAGE_SIZE_MAX.get(request, self.ERPLY_PAGE_SIZE_DEFAULT)
+
+    def _limit_page_size(self, request, size):
+        if size < self.page_size_max(request):
+            logger.warning('Server limits pages of %s to %d records', request, size)
+            self._page_size_limits[request] = size
+
+    def _page_params(self, request, kwargs, page):
+        data = kwargs.copy()
+        if page:
+            data['pageNo'] = page + 1
+        if data.get('recordsOnPage') == 'auto':
+            # Adaptive pagination starts with largest pages
+            data['recordsOnPage'] = self.page_size_max(request)
+            _last_response.set(None)
+        return data
 
     def handle_post(self, request, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return self.handle_post(request, *args, **kwargs)
+
         _is_bulk = kwargs.pop('_is_bulk', False)
         data = kwargs.copy()
         if _is_bulk:
@@ -226,28 +1389,124 @@ class Erply(object):
 
         # Retry request in case of token expiration
         if retry:
-            return getattr(self, request)(request, *args, **kwargs)
+            return self.handle_post(request, *args, **kwargs)
 
+        if self.cache is not None:
+            self.cache.invalidate_for(request)
         return ErplyResponse(self, parsed_data, request, *args, **kwargs)
 
     def handle_bulk(self, _requests):
-        data = self.payload
-        data.update(requests=_requests)
-        return ErplyBulkResponse(self, requests.post(self.api_url, data=data))
+        size, idempotent = self._bulk_options(_requests)
+        while True:
+            # Session key might have changed during retry
+            retry, parsed_data = self._erply_query(
+                dict(self.payload, requests=_requests), _batch_size=size, _idempotent=idempotent)
+            if not retry:
+                return ErplyBulkResponse(self, parsed_data)
+
+    def _bulk_options(self, _requests):
+        """Return number of calls in JSON encoded bulk `_requests` and
+        whether all of them are read requests."""
+        calls = self.codec.loads(_requests)
+        return len(calls), all(call.get('requestName') in self.ERPLY_GET for call in calls)
+
+    def batch(self, max_size=None):
+        """Collect calls made in this thread into bulk requests.
+
+        Inside the `with` block calls return :class:`concurrent.futures.Future`
+        objects which are resolved when the block exits::
+
+            with erply.batch():
+                product = erply.getProducts(productID=1)
+                saved = erply.saveProduct(productID=2, name='Foo')
+            print (product.result().total)
+
+        :param max_size: Maximum number of requests in single bulk call,
+            defaults to :attr:`ERPLY_BULK_MAX`.
+        """
+        return ErplyBatch(self, max_size)
 
-    def __getattr__(self, attr):
+    def writer(self, max_size=None, max_delay=1.0, max_queue=1000):
+        """Return :class:`ErplyWriter` sending queued writes in background::
+
+            with erply.writer() as writer:
+                for product in products:
+                    writer.saveProduct(**product)
+        """
+        return ErplyWriter(self, max_size, max_delay, max_queue)
+
+    def loader(self, request, id_field=None, list_param=None, max_batch=None,
+               window=0.01, **params):
+        """Return :class:`ErplyLoader` batching lookups of `request` by ID::
+
+            products = erply.loader('getProducts')
+            first, second = products.load(1), products.load(2)
+            print (first.result()['name'])
+        """
+        return ErplyLoader(self, request, id_field, list_param, max_batch, window, **params)
+
+    def _current_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def _send_bulk(self, calls):
+        """Send `calls` as a single bulk request.
+
+        `calls` is list of `(request, kwargs, future)` tuples, each future
+        is resolved with response matched by its `requestID`.
+        """
+        _requests = []
+        for n, (request, kwargs, _) in enumerate(calls, start=1):
+            handler = self.handle_get if request in self.ERPLY_GET else self.handle_post
+            _requests.append(handler(request, _is_bulk=True, requestID=n, **kwargs))
+        data = dict(requests=self.codec.dumps(_requests))
+
+        while True:
+            # Session key might have changed during retry
+            retry, parsed_data = self._erply_query(
+                dict(data, **self.payload), _batch_size=len(calls),
+                _idempotent=all(request in self.ERPLY_GET for request, _, _ in calls))
+            if not retry:
+                break
+
+        items = {}
+        for item in parsed_data.get('requests') or []:
+            items[str(item.get('status', {}).get('requestID'))] = item
+
+        for n, (request, kwargs, future) in enumerate(calls, start=1):
+            item = items.get(str(n))
+            if item is None:
+                future.set_exception(ErplyException('No response for bulk request {}'.format(n)))
+                continue
+            status = item.get('status', {})
+            if status.get('errorCode'):
+                future.set_exception(_status_error(status))
+                continue
+            if self.cache is not None and request in self.ERPLY_POST:
+                self.cache.invalidate_for(request)
+            kwargs = kwargs.copy()
+            page = kwargs.pop('_page', 0)
+            future.set_result(ErplyResponse(self, item, request, page, **kwargs))
+
+    def __getattr__(self, name):
         _attr = None
+        attr = name
         _is_bulk = len(attr) > 5 and attr.endswith('_bulk')
         if _is_bulk:
             attr = attr[:-5]
         if attr in self.ERPLY_GET:
             def method(*args, **kwargs):
+                batch = self._current_batch()
+                if batch is not None and not _is_bulk:
+                    return batch.add(attr, **kwargs)
                 _page = kwargs.pop('_page', 0)
                 _response = kwargs.pop('_response', None)
                 return self.handle_get(attr, _page, _response, _is_bulk=_is_bulk, *args, **kwargs)
             _attr = method
         elif attr in self.ERPLY_POST:
             def method(*args, **kwargs):
+                batch = self._current_batch()
+                if batch is not None and not _is_bulk:
+                    return batch.add(attr, **kwargs)
                 return self.handle_post(attr, _is_bulk=_is_bulk, *args, **kwargs)
             _attr = method
         elif attr in self.ERPLY_CSV:
@@ -255,16 +1514,16 @@ class Erply(object):
                 return self.handle_csv(attr, *args, **kwargs)
             _attr = method
         if _attr:
-            self.__dict__[attr] = _attr
-            return _attr
+            # Concurrent lookups of the same name keep the first method
+            return self.__dict__.setdefault(name, _attr)
         raise AttributeError
 
 
 class ErplyBulkRequest(object):
-    def __init__(self, erply,  _json_dumps):
+    def __init__(self, erply,  _json_dumps=None):
         self.calls = []
         self.erply = erply
-        self.json_dumper = _json_dumps
+        self.json_dumper = _json_dumps or erply.codec.dumps
 
     def attach(self, attr, *args, **kwargs):
         if attr in self.erply.ERPLY_GET or attr in self.erply.ERPLY_POST:
@@ -279,6 +1538,454 @@ class ErplyBulkRequest(object):
         return self.erply.handle_bulk(self.json_dumper(_requests))
 
 
+class ErplyBatch(object):
+    """Automatically coalesces calls into bulk requests, see :meth:`Erply.batch`.
+
+    Calls can also be added explicitly with `batch.getProducts(...)` or
+    `batch.add('getProducts', ...)`.
+    """
+
+    def __init__(self, erply, max_size=None):
+        self.erply = erply
+        self.max_size = min(max_size or erply.ERPLY_BULK_MAX, erply.ERPLY_BULK_MAX)
+        self._calls = []
+        self._previous = None
+
+    def add(self, request, **kwargs):
+        """Queue request and return future resolved with its response."""
+        if request not in self.erply.ERPLY_GET and request not in self.erply.ERPLY_POST:
+            raise ValueError('Request {} can not be sent in bulk'.format(request))
+        future = Future()
+        self._calls.append((request, kwargs, future))
+        return future
+
+    def flush(self):
+        """Send queued calls in chunks of at most `max_size` requests."""
+        calls, self._calls = self._calls, []
+        for start in range(0, len(calls), self.max_size):
+            chunk = calls[start:start + self.max_size]
+            try:
+                self.erply._send_bulk(chunk)
+            except Exception as e:
+                for _, _, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def __getattr__(self, attr):
+        if attr in self.erply.ERPLY_GET or attr in self.erply.ERPLY_POST:
+            def method(**kwargs):
+                return self.add(attr, **kwargs)
+            return method
+        raise AttributeError(attr)
+
+    def __enter__(self):
+        self._previous = self.erply._current_batch()
+        self.erply._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.erply._local.batch = self._previous
+        if exc_type is None:
+            self.flush()
+        else:
+            for _, _, future in self._calls:
+                future.cancel()
+            self._calls = []
+
+
+class ErplyWriter(object):
+    """Write-behind queue sending write calls as bulk requests from a
+    background thread, see :meth:`Erply.writer`.
+
+    Queued calls are sent once `max_size` of them have been collected or
+    `max_delay` seconds after the first one was queued. When `max_queue`
+    calls are waiting, :meth:`add` blocks until there is room again.
+
+    :meth:`flush` and :meth:`close` return only after all calls queued
+    before them have been sent.
+    """
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, erply, max_size=None, max_delay=1.0, max_queue=1000):
+        self.erply = erply
+        self.max_size = min(max_size or erply.ERPLY_BULK_MAX, erply.ERPLY_BULK_MAX)
+        self.max_delay = max_delay
+        self._queue = queue.Queue(max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        # Do not lose queued writes when interpreter exits without close()
+        atexit.register(self.close)
+
+    def add(self, request, timeout=None, **kwargs):
+        """Queue write call and return future resolved with its response.
+
+        :param timeout: Seconds to wait for room in full queue before
+            raising :class:`queue.Full`, by default waits indefinitely.
+        """
+        if request not in self.erply.ERPLY_POST:
+            raise ValueError('Request {} is not a write call'.format(request))
+        if self._closed:
+            raise RuntimeError('Writer is closed')
+        future = Future()
+        self._queue.put((request, kwargs, future), timeout=timeout)
+        return future
+
+    def flush(self):
+        """Send all queued calls and wait until they are done."""
+        if self._thread.is_alive():
+            self._queue.put(self._FLUSH)
+        self._queue.join()
+
+    def close(self):
+        """Flush queued calls and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            calls = []
+            item = self._queue.get()
+            taken = 1
+            expires = monotonic() + self.max_delay
+            # Collect calls until bulk is full, delay expires or flush is requested
+            while item is not self._FLUSH and item is not self._STOP:
+                calls.append(item)
+                if len(calls) >= self.max_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(expires - monotonic(), 0))
+                except queue.Empty:
+                    break
+                taken += 1
+
+            if calls:
+                self._send(calls)
+            for _ in range(taken):
+                self._queue.task_done()
+            if item is self._STOP:
+                return
+
+    def _send(self, calls):
+        try:
+            self.erply._send_bulk(calls)
+        except Exception as e:
+            logger.exception('Sending %d queued writes failed', len(calls))
+            for _, _, future in calls:
+                if not future.done():
+                    future.set_exception(e)
+
+    def __getattr__(self, attr):
+        if attr in self.erply.ERPLY_POST:
+            def method(**kwargs):
+                return self.add(attr, **kwargs)
+            return method
+        raise AttributeError(attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ErplyLoader(object):
+    """Collects lookups of single records by ID into few requests, see
+    :meth:`Erply.loader`.
+
+    IDs loaded within `window` seconds of each other (or until
+    :meth:`dispatch` is called) are deduplicated and fetched with single
+    request filtering by list of IDs (eg. `productIDs=1,2,3`). Requests
+    without such filter are sent as bulk requests. Futures are cached by
+    ID for the lifetime of the loader.
+
+    :param id_field: Record field containing the ID, known for requests
+        listed in :attr:`LOOKUPS`.
+    :param list_param: Request parameter accepting comma separated IDs.
+    :param max_batch: Maximum number of IDs fetched by a single request.
+    :param window: Seconds to wait for more IDs before fetching, `None`
+        fetches only when :meth:`dispatch` is called or batch is full.
+    """
+
+    # Request: (ID field, parameter accepting list of IDs)
+    LOOKUPS = {
+        'getProducts': ('productID', 'productIDs'),
+        'getCustomers': ('customerID', 'customerIDs'),
+        'getWarehouses': ('warehouseID', None),
+        'getSalesDocuments': ('id', 'ids'),
+    }
+
+    def __init__(self, erply, request, id_field=None, list_param=None, max_batch=None,
+                 window=0.01, **params):
+        if request not in erply.ERPLY_GET:
+            raise ValueError('Request {} can not be used for lookups'.format(request))
+        default_field, default_param = self.LOOKUPS.get(request, (None, None))
+        self.id_field = id_field or default_field
+        if self.id_field is None:
+            raise ValueError('ID field of {} is required'.format(request))
+        if list_param is None and self.id_field == default_field:
+            list_param = default_param
+
+        self.erply = erply
+        self.request = request
+        self.list_param = list_param
+        self.max_batch = min(max_batch or erply.ERPLY_BULK_MAX, erply.ERPLY_BULK_MAX)
+        self.window = window
+        self.params = params
+        self._cache = {}
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        """Return future resolved with record of `key`, or `None` when it does not exist."""
+        key = str(key)
+        batch = None
+        with self._lock:
+            future = self._cache.get(key)
+            if future is not None:
+                return future
+            future = self._cache[key] = Future()
+            self._pending.append((key, future))
+            if len(self._pending) >= self.max_batch:
+                batch, self._pending = self._pending, []
+            elif self._timer is None and self.window is not None:
+                self._timer = threading.Timer(self.window, self.dispatch)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._fetch(batch)
+        return future
+
+    def load_many(self, keys):
+        """Load all `keys` at once and return list of their records."""
+        futures = [self.load(key) for key in keys]
+        self.dispatch()
+        return [future.result() for future in futures]
+
+    def dispatch(self):
+        """Fetch pending IDs without waiting for the batch window."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for start in range(0, len(pending), self.max_batch):
+            self._fetch(pending[start:start + self.max_batch])
+
+    def prime(self, key, record):
+        """Add `record` of `key` to the cache."""
+        future = Future()
+        future.set_result(record)
+        with self._lock:
+            self._cache.setdefault(str(key), future)
+
+    def clear(self, key=None):
+        """Remove `key` or all IDs from the cache."""
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(str(key), None)
+
+    def _fetch(self, pending):
+        try:
+            if self.list_param:
+                records = self._fetch_list([key for key, _ in pending])
+            else:
+                records = self._fetch_bulk(pending)
+        except Exception as e:
+            records = e
+        for key, future in pending:
+            result = records.get(key) if isinstance(records, dict) else records
+            if isinstance(result, Exception):
+                # Failed lookups are not cached
+                with self._lock:
+                    if self._cache.get(key) is future:
+                        del self._cache[key]
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _fetch_list(self, keys):
+        params = dict(self.params, recordsOnPage=len(keys))
+        params[self.list_param] = ','.join(keys)
+        response = self.erply.handle_get(self.request, 0, **params)
+        return dict((str(record.get(self.id_field)), record)
+                    for record in response.iter_records())
+
+    def _fetch_bulk(self, pending):
+        calls = []
+        for key, _ in pending:
+            params = dict(self.params)
+            params[self.id_field] = key
+            calls.append((self.request, params, Future()))
+        self.erply._send_bulk(calls)
+
+        records = {}
+        for (key, _), (_, _, future) in zip(pending, calls):
+            try:
+                response = future.result()
+                records[key] = response[0][0] if response.total else None
+            except Exception as e:
+                records[key] = e
+        return records
+
+
+_MISSING = object()
+
+
+class ErplyRecord(Mapping):
+    """Read-only record of :class:`ErplyRecordPage`.
+
+    Field names are shared by all records of the page, only values are
+    stored per record.
+    """
+
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        value = self._values[self._index[key]]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, position in self._index.items():
+            if self._values[position] is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for value in self._values if value is not _MISSING)
+
+    def __repr__(self):
+        return 'ErplyRecord({!r})'.format(dict(self))
+
+
+class ErplyRecordPage(Sequence):
+    """Compact page of records stored as tuples sharing one key schema."""
+
+    __slots__ = ('keys', '_index', '_rows')
+
+    def __init__(self, records, schemas=None):
+        keys = []
+        seen = set()
+        for record in records:
+            for key in record:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        keys = tuple(keys)
+
+        # Pages with same fields share the key index
+        if schemas is None:
+            schemas = {}
+        if keys not in schemas:
+            schemas[keys] = dict((key, n) for n, key in enumerate(keys))
+        self.keys = keys
+        self._index = schemas[keys]
+        self._rows = [tuple(record.get(key, _MISSING) for key in keys) for record in records]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [ErplyRecord(self._index, row) for row in self._rows[key]]
+        return ErplyRecord(self._index, self._rows[key])
+
+    def __len__(self):
+        return len(self._rows)
+
+    def column(self, key):
+        """Return list of values of field `key`, `None` when missing."""
+        position = self._index[key]
+        return [None if row[position] is _MISSING else row[position] for row in self._rows]
+
+
+class _PageSizer(object):
+    """Picks number of records fetched per request for adaptive pagination.
+
+    Sizes are divisors of the logical page size, so every page can be
+    fetched as whole number of smaller requests. Size is halved when
+    responses are slow or large and doubled again when they are fast.
+    """
+
+    min_size = 20
+    # Response times in seconds
+    slow = 5.0
+    fast = 1.0
+    # Response size in bytes
+    max_bytes = 8 * 1024 * 1024
+
+    def __init__(self, page_size):
+        self.sizes = [n for n in range(1, page_size + 1)
+                      if page_size % n == 0 and n >= min(self.min_size, page_size)]
+        self.size = page_size
+
+    def update(self, duration, size):
+        if duration > self.slow or size > self.max_bytes:
+            self.size = max([n for n in self.sizes if n <= self.size // 2] or self.sizes[:1])
+        elif duration < self.fast and size < self.max_bytes // 4:
+            self.size = min([n for n in self.sizes if n >= self.size * 2] or self.sizes[-1:])
+
+    def fit(self, offset):
+        """Largest size not above current one whose pages start at `offset`."""
+        for n in reversed(self.sizes):
+            if n <= self.size and offset % n == 0:
+                return n
+        return self.sizes[0]
+
+
+class _PageStore(OrderedDict):
+    """Fetched pages, optionally keeping only the most recent `max_pages`.
+
+    Pages which have not been decoded yet are passed through `load` when
+    accessed for the first time.
+    """
+
+    def __init__(self, max_pages=None, load=None):
+        super(_PageStore, self).__init__()
+        self.max_pages = max_pages
+        self._load = load
+        self._lock = threading.RLock()
+
+    def __getitem__(self, page):
+        records = super(_PageStore, self).__getitem__(page)
+        if isinstance(records, _LazyRecords):
+            with self._lock:
+                # Page might have been decoded or evicted by another thread
+                records = super(_PageStore, self).__getitem__(page)
+                if isinstance(records, _LazyRecords):
+                    records = records.load()
+                    if self._load is not None:
+                        records = self._load(records)
+                    # Replacing existing key keeps its position
+                    super(_PageStore, self).__setitem__(page, records)
+        return records
+
+    def get(self, page, default=None):
+        try:
+            return self[page]
+        except KeyError:
+            return default
+
+    def add(self, page, records):
+        with self._lock:
+            self[page] = records
+            self.move_to_end(page)
+            while self.max_pages and len(self) > self.max_pages:
+                self.popitem(last=False)
+
+
 class ErplyResponse(object):
 
     def __init__(self, erply, data, request, page=0, *args, **kwargs):
@@ -288,31 +1995,202 @@ class ErplyResponse(object):
 
         # Result pagination setup
         self.page = page
-        self.per_page = kwargs.get('recordsOnPage', 20)
+        per_page = kwargs.get('recordsOnPage', 20)
+        # With `recordsOnPage='auto'` pages keep their size, but are fetched
+        # with as many requests as needed to keep responses fast
+        self.page_sizer = None
+        if per_page == 'auto':
+            per_page = erply.page_size_max(request)
+            self.page_sizer = _PageSizer(per_page)
+            if _last_response.get() is not None:
+                self.page_sizer.update(*_last_response.get())
+        self.per_page = int(per_page)
 
         self.kwargs = kwargs
 
         status = data.get('status', {})
 
         self.total = status.get('recordsTotal')
-        self.records = { page: data.get('records')}
-
+        self._check_page_size(status.get('recordsInResponse'), page)
+
+        # Storage of fetched pages, see Erply `compact_records` and
+        # `max_pages` options.
+        self.compact = getattr(erply, 'compact_records', False)
+        self._schemas = {}
+        self.records = _PageStore(getattr(erply, 'max_pages', None), self._load_page)
+        self.populate_page(_payload_records(data), page)
+
+        server_time = status.get('requestUnixTime')
+        self.timestamp = datetime.fromtimestamp(server_time) if server_time else None
+
+        # Deadline of the original call also applies to following pages
+        self.deadline = _call_deadline.get()
+
+
+    def _check_page_size(self, count, page):
+        """Verify that only the last page holds less than `per_page` records."""
+        if self.total is None or count is None:
+            return
+        expected = min(self.per_page, self.total - page * self.per_page)
+        if count >= expected:
+            return
+        if page or not count:
+            raise ErplyException('Page {} of {} has {} records instead of {}'.format(
+                page, self.request, count, expected))
+        # Server allows less records on a page than requested, following
+        # pages are fetched with its page size
+        self.erply._limit_page_size(self.request, count)
+        self.per_page = count
+        if self.page_sizer is not None:
+            self.page_sizer = _PageSizer(count)
+        else:
+            self.kwargs = dict(self.kwargs, recordsOnPage=count)
 
     def fetchone(self):
         if self.total == 1:
-            return self.records[0][0]
+            return self[0][0]
         raise ValueError
 
+    @property
+    def pages(self):
+        """Total number of pages in result set."""
+        if not self.total:
+            return 0
+        return -(-self.total // self.per_page)
+
     def fetch_records(self, page):
-        self.erply.handle_get(self.request, _page=page, _response=self, **self.kwargs)
+        """Fetch `page` into the response and return its records.
+
+        Returned records stay usable even when the page has already been
+        evicted because of `max_pages`.
+        """
+        with _call_options(deadline=self.deadline):
+            if self.page_sizer is None:
+                response = self.erply.handle_get(self.request, _page=page, _response=self,
+                                                 **self.kwargs)
+                return response.records.get(page)
+
+            records = []
+            for offset, size in self._sub_pages(page):
+                _last_response.set(None)
+                response = self.erply.handle_get(self.request, offset // size,
+                                                 **dict(self.kwargs, recordsOnPage=size))
+                records.extend(self._sub_page_records(response, offset // size))
+            return self.populate_page(records, page)
+
+    def _sub_pages(self, page):
+        """Yield `(offset, size)` of requests needed to fetch `page`."""
+        start = page * self.per_page
+        end = start + self.per_page
+        if self.total is not None:
+            end = min(end, self.total)
+        offset = start
+        while offset < end:
+            size = self.page_sizer.fit(offset - start)
+            yield offset, size
+            offset += size
+
+    def _sub_page_records(self, response, page):
+        if _last_response.get() is not None:
+            self.page_sizer.update(*_last_response.get())
+        return response.records.get(page) or []
+
+    @property
+    def max_pages(self):
+        return self.records.max_pages
+
+    @max_pages.setter
+    def max_pages(self, value):
+        self.records.max_pages = value
+
+    def _load_page(self, data):
+        if self.compact and data is not None:
+            return ErplyRecordPage(data, self._schemas)
+        return data
 
     def populate_page(self, data, page):
         assert self.per_page != 0
-        self.records[page] = data
+        if not isinstance(data, _LazyRecords):
+            data = self._load_page(data)
+        self.records.add(page, data)
+        return data
+
+    def fetch_pages(self, pages=None):
+        """Fetch `pages` (all pages not fetched yet by default) packed into
+        bulk requests of up to :attr:`Erply.ERPLY_BULK_MAX` pages each.
+        """
+        if pages is None:
+            pages = [page for page in range(self.pages) if page not in self.records]
+        for chunk in self._bulk_pages(pages):
+            for page, records in chunk:
+                self.populate_page(records, page)
+
+    def _bulk_pages(self, pages):
+        """Yield list of `(page, records)` for each bulk request made."""
+        size = self.erply.ERPLY_BULK_MAX
+        for start in range(0, len(pages), size):
+            chunk = pages[start:start + size]
+            calls = [(self.request, dict(self.kwargs, _page=page), Future()) for page in chunk]
+            with _call_options(deadline=self.deadline):
+                self.erply._send_bulk(calls)
+            yield [(page, future.result().records.get(page))
+                   for page, (_, _, future) in zip(chunk, calls)]
+
+    def iter_records(self, prefetch=0, bulk=False):
+        """Iterate over records of all pages in order.
+
+        :param prefetch: Number of pages to fetch concurrently ahead of the
+            page currently being consumed. By default pages are fetched
+            one by one when needed.
+        :param bulk: Fetch missing pages with bulk requests, each of them
+            returning up to :attr:`Erply.ERPLY_BULK_MAX` pages.
+        """
+        if bulk:
+            page = 0
+            while page < self.pages:
+                records = self.records.get(page)
+                if records is None:
+                    end = min(page + self.erply.ERPLY_BULK_MAX, self.pages)
+                    chunk, = self._bulk_pages(list(range(page, end)))
+                else:
+                    chunk = [(page, records)]
+                for page, records in chunk:
+                    self.populate_page(records, page)
+                    for record in records or []:
+                        yield record
+                page += 1
+            return
+
+        if not prefetch:
+            for page in self:
+                for record in page:
+                    yield record
+            return
+
+        pending = {}
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            try:
+                for page in range(self.pages):
+                    # Already fetched page is taken before pages fetched ahead
+                    # can evict it from the store
+                    records = None if page in pending else self.records.get(page)
+                    first = page if records is None else page + 1
+                    for ahead in range(first, min(page + prefetch + 1, self.pages)):
+                        if ahead not in pending and ahead not in self.records:
+                            pending[ahead] = executor.submit(self.fetch_records, ahead)
+                    # Prefetched records are kept by the future
+                    if page in pending:
+                        records = pending.pop(page).result()
+                    for record in records if records is not None else self[page]:
+                        yield record
+            finally:
+                # Iteration was stopped early, drop pages not started yet
+                for future in pending.values():
+                    future.cancel()
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            raise NotImplementedError
+            return [self[page] for page in range(*key.indices(self.pages))]
         if self.per_page * key >= self.total:
             raise IndexError
         if key not in self.records:
@@ -320,9 +2198,263 @@ class ErplyResponse(object):
         return self.records[key]
 
 
+class _CSVFeed(object):
+    """Incremental CSV parser fed with chunks of bytes.
+
+    Chunks are decoded and split into lines as they arrive, rows are only
+    handed to :func:`csv.reader` once all lines of (possibly multi-line
+    quoted) record have been received.
+    """
+
+    def __init__(self, encoding, **fmtparams):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._buffer = ''
+        self._lines = deque()
+        self._quotes = 0
+        self._reader = csv.reader(self, **fmtparams)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._lines:
+            raise StopIteration
+        return self._lines.popleft()
+
+    def _push(self, lines):
+        rows = []
+        for line in lines:
+            self._lines.append(line)
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                self._quotes = 0
+                rows.append(next(self._reader))
+        return rows
+
+    def feed(self, chunk):
+        """Return list of rows completed by `chunk`."""
+        self._buffer += self._decoder.decode(chunk)
+        lines = self._buffer.split('\n')
+        self._buffer = lines.pop()
+        return self._push([line + '\n' for line in lines])
+
+    def close(self):
+        """Return remaining rows once all the chunks have been fed."""
+        rest = self._buffer + self._decoder.decode(b'', final=True)
+        self._buffer = ''
+        rows = self._push([rest] if rest else [])
+        # Unterminated quoted field at the end of data
+        rows.extend(self._reader)
+        return rows
+
+
+def _strip_rows(rows, skip_header=0, skip_footer=0):
+    """Drop `skip_header` first and `skip_footer` last rows of iterable."""
+    rows = iter(rows)
+    for _ in range(skip_header):
+        if next(rows, None) is None:
+            return
+    lookahead = deque()
+    for row in rows:
+        lookahead.append(row)
+        if len(lookahead) > skip_footer:
+            yield lookahead.popleft()
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _parse_datetime(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+# Column type: (parser, array typecode, NumPy dtype), tried in this order
+# when inferring schema of a report
+CSV_COLUMN_TYPES = OrderedDict([
+    ('int', (int, 'q', 'int64')),
+    ('float', (float, 'd', 'float64')),
+    ('date', (_parse_date, None, 'datetime64[D]')),
+    ('datetime', (_parse_datetime, None, 'datetime64[s]')),
+    ('str', (str, None, object)),
+])
+
+
+def _infer_column_type(values):
+    present = [value for value in values if value != '']
+    for name, (parse, _, _) in CSV_COLUMN_TYPES.items():
+        try:
+            for value in present:
+                parse(value)
+        except ValueError:
+            continue
+        # Missing values of numeric columns are stored as NaN
+        return 'float' if name == 'int' and len(present) < len(values) else name
+    return 'str'
+
+
+def _widen_column_type(kind, values):
+    """Return `kind`, or wider type if some of `values` do not fit it."""
+    present = [value for value in values if value != '']
+    for name in (kind, 'float', 'str') if kind == 'int' else (kind, 'str'):
+        try:
+            for value in present:
+                CSV_COLUMN_TYPES[name][0](value)
+        except ValueError:
+            continue
+        return name
+
+
+def _column_array(name, kind, values, use_numpy):
+    """Convert string `values` of column `name` to array of type `kind`."""
+    parse, typecode, dtype = CSV_COLUMN_TYPES[kind]
+    numpy = _optional_module('numpy') if use_numpy else None
+    try:
+        if kind == 'str':
+            return numpy.array(values, dtype=object) if use_numpy else list(values)
+        if kind in ('date', 'datetime'):
+            if use_numpy:
+                return numpy.array([value or 'NaT' for value in values], dtype=dtype)
+            return [parse(value) if value else None for value in values]
+        if use_numpy:
+            # Conversion of the whole column happens in NumPy
+            return numpy.array(values).astype(dtype)
+        return array(typecode, map(parse, values))
+    except ValueError as e:
+        raise ValueError('Column {} is not {}: {}'.format(name, kind, e))
+
+
+class _ReportColumns(object):
+    """Converts rows of CSV report into typed column batches.
+
+    Rows are fed one at a time. Title rows before the table and summary
+    rows after it are detected, unless their position is given.
+    """
+
+    # Consecutive rows of same width marking start of the table
+    min_table_rows = 3
+    # Rows searched for start of the table
+    max_title_rows = 50
+    # First cell of summary rows following the table
+    summary_labels = re.compile(
+        r'\s*(grand total|totals?|sum|summa|kokku|yhteensä|kopā|iš viso|итого|всего)\s*:?\s*$',
+        re.IGNORECASE)
+
+    def __init__(self, batch_size, schema=None, header_row=None, skip_footer=None,
+                 use_numpy=None):
+        self.batch_size = batch_size
+        self.schema = OrderedDict(schema) if schema else None
+        self.header_row = header_row
+        self.skip_footer = skip_footer
+        numpy = _optional_module('numpy') if use_numpy is not False else None
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        if self.use_numpy and numpy is None:
+            raise ImportError('NumPy is not installed')
+        self.columns = None
+        self._title = []
+        self._rows = []
+        self._footer = deque()
+        # Columns with inferred type, widened when following batches need it
+        self._inferred = ()
+        self._done = False
+
+    def feed(self, row):
+        """Return list of batches completed by `row`."""
+        if self._done:
+            return []
+        if self.columns is None:
+            self._title.append(row)
+            return self._find_table()
+
+        if self.skip_footer is None:
+            if len(row) != len(self.columns) or not any(row) or self.summary_labels.match(row[0]):
+                # Table ends with empty, differently sized or summary row
+                self._done = True
+                return []
+        elif self.skip_footer:
+            self._footer.append(row)
+            if len(self._footer) <= self.skip_footer:
+                return []
+            row = self._footer.popleft()
+
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            return [self._batch()]
+        return []
+
+    def close(self):
+        """Return remaining batches once all the rows have been fed."""
+        batches = []
+        if self.columns is None and self.header_row is None:
+            # Report shorter than `min_table_rows`
+            starts = (self._table_start(n) for n in range(self.min_table_rows - 1, 0, -1))
+            self.header_row = next((start for start in starts if start is not None), 0)
+        if self.columns is None:
+            batches.extend(self._find_table())
+        if self._rows:
+            batches.append(self._batch())
+        return batches
+
+    def _table_start(self, min_rows):
+        rows = self._title
+        for start in range(len(rows) - min_rows + 1):
+            width = len(rows[start])
+            # All columns of the table have names
+            if width > 1 and all(rows[start]) and all(
+                    len(row) == width and any(row) for row in rows[start:start + min_rows]):
+                return start
+        return None
+
+    def _find_table(self):
+        start = self.header_row
+        if start is None:
+            start = self._table_start(self.min_table_rows)
+            if start is None and len(self._title) >= self.max_title_rows:
+                start = 0
+        if start is None or len(self._title) <= start:
+            return []
+
+        rows, self._title = self._title, []
+        self.columns = rows[start]
+        batches = []
+        for row in rows[start + 1:]:
+            batches.extend(self.feed(row))
+        return batches
+
+    def _batch(self):
+        rows, self._rows = self._rows, []
+        values = list(zip(*rows)) if rows else [()] * len(self.columns)
+        if self.schema is None:
+            self._inferred = set(self.columns)
+            self.schema = OrderedDict(
+                (name, _infer_column_type(column)) for name, column in zip(self.columns, values))
+        else:
+            for name, column in zip(self.columns, values):
+                if name in self._inferred:
+                    self.schema[name] = _widen_column_type(self.schema[name], column)
+        return self._convert(values)
+
+    def _convert(self, values):
+        batch = OrderedDict()
+        for name, column in zip(self.columns, values):
+            kind = self.schema.get(name, 'str')
+            if kind == 'int' and '' in column:
+                # Following batches keep the promoted type
+                kind = self.schema[name] = 'float'
+            if kind == 'float':
+                column = [value or 'nan' for value in column]
+            batch[name] = _column_array(name, kind, column, self.use_numpy)
+        return batch
+
+
 class ErplyCSVResponse(object):
 
-    def __init__(self, erply, data):
+    # Size of chunks read from the report stream
+    chunk_size = 64 * 1024
+    # Reports larger than this are spooled to disk instead of memory
+    spool_max_memory = 1024 * 1024
+
+    def __init__(self, erply, data, encoding=None):
         self.erply = erply
 
         status = data.get('status', {})
@@ -330,30 +2462,137 @@ class ErplyCSVResponse(object):
         self.url = data.get('records').pop().get('reportLink')
         self.timestamp = datetime.fromtimestamp(status.get('requestUnixTime'))
 
+        # Report encoding, detected from response headers when not set
+        self.encoding = encoding
+
+        # Downloaded copy of the report, allows iterating multiple times
+        # without downloading the report again. Every download writes its
+        # own spool, which is cached once the download is complete.
+        self._spool = None
+        self._spool_encoding = None
+        # Number of iterations reading each spool
+        self._spool_readers = {}
 
     @property
     def records(self):
-        # TODO: Rework so we can use proper iterator...
-        with closing(requests.get(self.url, stream=True)) as f:
-            if f.status_code != requests.codes.ok:
-                raise ValueError
-            # XXX: Check whether we have to make it configurable...
-            # XXX: Should we remove header and footer?
-            return csv.reader(f.text.splitlines(), delimiter=';')
+        return self.iter_rows()
+
+    def iter_rows(self, skip_header=0, skip_footer=0, refresh=False, cache=True):
+        """Stream rows of the report with constant memory usage.
+
+        :param skip_header: Number of leading rows (report header) to skip.
+        :param skip_footer: Number of trailing rows (report footer) to skip.
+        :param refresh: Download report again even if it has been cached.
+        :param cache: Keep downloaded copy of report for following
+            iterations (spooled to a temporary file for large reports).
+        """
+        return _strip_rows(self._iter_rows(refresh, cache), skip_header, skip_footer)
+
+    def iter_batches(self, batch_size=10000, schema=None, header_row=None, skip_footer=None,
+                     use_numpy=None, refresh=False, cache=True):
+        """Stream report as batches of typed columns.
+
+        Each batch is an ordered dict of column name to NumPy array (when
+        available) or :class:`array.array`, text and dates are stored in
+        lists without NumPy.
+
+        :param schema: Mapping of column name to type (one of
+            :data:`CSV_COLUMN_TYPES`), inferred from first batch when not set.
+            Inferred types are widened (eg. `int` to `float` or `str`) when
+            values of following batches do not fit them.
+        :param header_row: Index of the row containing column names,
+            detected when not set.
+        :param skip_footer: Number of summary rows after the table, when not
+            set the table ends at first empty, differently sized or summary
+            (eg. `Total`) row.
+        """
+        columns = _ReportColumns(batch_size, schema, header_row, skip_footer, use_numpy)
+        for row in self._iter_rows(refresh, cache):
+            for batch in columns.feed(row):
+                yield batch
+        for batch in columns.close():
+            yield batch
+
+    def close(self):
+        """Drop cached copy of the report.
+
+        Response can also be used as context manager closing it on exit.
+        """
+        spool, self._spool = self._spool, None
+        self._release_spool(spool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_spool(self, cache):
+        return SpooledTemporaryFile(max_size=self.spool_max_memory) if cache else None
+
+    def _publish_spool(self, spool, encoding):
+        """Cache `spool` holding completely downloaded report."""
+        self.close()
+        self._spool, self._spool_encoding = spool, encoding
+
+    def _release_spool(self, spool):
+        # Spool is closed once it is neither cached nor being read
+        if spool is not None and spool is not self._spool and spool not in self._spool_readers:
+            spool.close()
+
+    def _replay_chunks(self):
+        spool = self._spool
+        self._spool_readers[spool] = self._spool_readers.get(spool, 0) + 1
+        try:
+            offset = 0
+            while True:
+                # Seek on every read so several iterations can be interleaved
+                spool.seek(offset)
+                chunk = spool.read(self.chunk_size)
+                if not chunk:
+                    return
+                offset += len(chunk)
+                yield chunk
+        finally:
+            self._spool_readers[spool] -= 1
+            if not self._spool_readers[spool]:
+                del self._spool_readers[spool]
+            self._release_spool(spool)
+
+    def _iter_rows(self, refresh, cache):
+        if self._spool is not None and not refresh:
+            feed = _CSVFeed(self._spool_encoding, delimiter=';')
+            for chunk in self._replay_chunks():
+                for row in feed.feed(chunk):
+                    yield row
+        else:
+            spool = self._new_spool(cache)
+            try:
+                timeout = self.erply._request_timeout()
+                with closing(self.erply.transport.get(self.url, stream=True, timeout=timeout)) as f:
+                    if f.status_code != requests.codes.ok:
+                        raise ValueError
+                    encoding = self.encoding or f.encoding or 'utf-8'
+                    feed = _CSVFeed(encoding, delimiter=';')
+                    for chunk in f.iter_content(self.chunk_size):
+                        if spool is not None:
+                            spool.write(chunk)
+                        for row in feed.feed(chunk):
+                            yield row
+                if spool is not None:
+                    self._publish_spool(spool, encoding)
+            finally:
+                # Incomplete download is dropped
+                self._release_spool(spool)
+        for row in feed.close():
+            yield row
 
 
 class ErplyBulkResponse(object):
     # TODO: This class will be reworked in the future..
-    def __init__(self, erply, response):
-        if response.status_code != requests.codes.ok:
-            print ('Request failed with error code {}'.format(response.status_code))
-            raise ValueError
-
-        self.data = response.json()
+    def __init__(self, erply, data):
+        self.data = data
         status = self.data.get('status', {})
-        if not status:
-            print ("Malformed response")
-            raise ValueError
 
         self.error = status.get('errorCode')
         self._requests = self.data.get('requests')
@@ -366,9 +2605,977 @@ class ErplyBulkResponse(object):
         for el in self._requests:
             _status = el.get('status')
             if _status.get('responseStatus') == 'error':
-                print ('Request failed: requestID: {} errorField: {}'.format(
-                        _status.get('requestID'),
-                        _status.get('errorField'),
-                       ))
+                logger.warning('Request failed: requestID: %s errorField: %s',
+                               _status.get('requestID'),
+                               _status.get('errorField'))
             else:
                 yield el.get('records')
+
+
+def _run_params(request, **params):
+    """Normalized parameters of a resumable run over pages of `request`.
+
+    Stored together with progress, so that interrupted run is only resumed
+    at its page offset when pages are requested the same way.
+    """
+    return json.dumps(dict(params, request=request), sort_keys=True, default=str)
+
+
+class ErplySync(object):
+    """Incrementally mirror Erply records into a local SQLite database.
+
+    Each synced request type is kept in its own `mirror_<name>` table of
+    JSON encoded records keyed by id. Only records changed since the
+    previous run (using Erply's `changedSince` filter) are fetched. Every
+    page is stored together with sync progress, so an interrupted run is
+    resumed without fetching already stored pages again::
+
+        sync = ErplySync(erply, 'mirror.db')
+        sync.sync('getProducts')
+        product = sync.get('getProducts', 1)
+    """
+
+    ID_FIELDS = {
+        'getCustomers': 'customerID',
+        'getEmployees': 'employeeID',
+        'getProductStock': 'productID',
+        'getProducts': 'productID',
+        'getPurchaseDocuments': 'id',
+        'getSalesDocuments': 'id',
+        'getWarehouses': 'warehouseID',
+    }
+
+    def __init__(self, erply, path, per_page=100, timeout=30):
+        self.erply = erply
+        self.per_page = per_page
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS erply_sync_state ('
+                         'name TEXT PRIMARY KEY, since INTEGER, run_since INTEGER, '
+                         'run_started INTEGER, next_page INTEGER, params TEXT)')
+
+    def _table(self, name):
+        if not re.match(r'^\w+$', name):
+            raise ValueError('Invalid mirror name {}'.format(name))
+        table = 'mirror_{}'.format(name)
+        self._db.execute('CREATE TABLE IF NOT EXISTS {} ('
+                         'id TEXT PRIMARY KEY, data TEXT)'.format(table))
+        return table
+
+    def _state(self, name):
+        row = self._db.execute('SELECT since, run_since, run_started, next_page, params '
+                               'FROM erply_sync_state WHERE name = ?', (name,)).fetchone()
+        return row or (None, None, None, 0, None)
+
+    def _set_state(self, name, since, run_since, run_started, next_page, params=None):
+        self._db.execute('INSERT OR REPLACE INTO erply_sync_state VALUES (?, ?, ?, ?, ?, ?)',
+                         (name, since, run_since, run_started, next_page, params))
+
+    def sync(self, request, name=None, id_field=None, **kwargs):
+        """Fetch records of `request` changed since last sync.
+
+        :param name: Mirror name, defaults to request name. Use separate
+            names when syncing same request with different parameters.
+        :param id_field: Record field used as key, see :attr:`ID_FIELDS`.
+
+        Returns number of records stored.
+        """
+        name = name or request
+        id_field = id_field or self.ID_FIELDS[request]
+        table = self._table(name)
+
+        kwargs.setdefault('recordsOnPage', self.per_page)
+        params = _run_params(request, kwargs=kwargs)
+
+        since, run_since, run_started, page, run_params = self._state(name)
+        if run_started is not None and run_params != params:
+            logger.info('Parameters of %s changed, restarting interrupted sync', name)
+            run_started = None
+        if run_started is None:
+            # Start new run, otherwise resume interrupted one
+            run_since, page = since, 0
+
+        if run_since:
+            kwargs['changedSince'] = run_since
+
+        response = self.erply.handle_get(request, page, None, **kwargs)
+        if run_started is None:
+            # Changes made while this run is in progress are picked up by the
+            # next run.
+            run_started = int(response.timestamp.timestamp()) if response.timestamp else int(time())
+            self._set_state(name, since, run_since, run_started, page, params)
+
+        stored = 0
+        for page in range(page, response.pages):
+            records = response[page] or []
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(table),
+                    [(str(r[id_field]), json.dumps(dict(r))) for r in records])
+                self._set_state(name, since, run_since, run_started, page + 1, params)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            stored += len(records)
+            # Stored pages are not needed in memory anymore
+            response.records.pop(page, None)
+
+        self._set_state(name, run_started, None, None, 0)
+        return stored
+
+    def get(self, name, id):
+        """Return mirrored record by id, or `None`."""
+        row = self._db.execute('SELECT data FROM {} WHERE id = ?'.format(self._table(name)),
+                               (str(id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def records(self, name):
+        """Iterate over all mirrored records."""
+        for row in self._db.execute('SELECT data FROM {}'.format(self._table(name))):
+            yield json.loads(row[0])
+
+    def close(self):
+        self._db.close()
+
+
+class ErplyPull(object):
+    """Resumable pull of all records of a request into NDJSON or CSV file.
+
+    Progress is kept in a JSON checkpoint file next to the output, which
+    is replaced atomically after each page has been written and synced to
+    disk. Interrupted pull continues from the first missing page, records
+    written after the last checkpoint are discarded::
+
+        pull = ErplyPull(erply, 'getSalesDocuments', 'documents.ndjson')
+        pull.run()
+
+    Pages are addressed by offset, so when number of records has changed
+    since the pull was started :class:`ErplyException` is raised unless
+    `restart_on_change` is set, which starts the pull over.
+
+    :param checkpoint: Path of checkpoint file, defaults to `path` with
+        `.checkpoint` suffix.
+    :param format: Format of the output file, `ndjson` or `csv` (formats
+        which can be appended to, see :func:`export`).
+    :param fields: Names of fields to write.
+    """
+
+    FORMATS = ('ndjson', 'csv')
+
+    def __init__(self, erply, request, path, checkpoint=None, per_page=100,
+                 restart_on_change=False, format='ndjson', fields=None, **kwargs):
+        if request not in erply.ERPLY_GET:
+            raise ValueError('Request {} can not be pulled'.format(request))
+        if format not in self.FORMATS:
+            raise ValueError('Pull can not be resumed in {} format'.format(format))
+        self.erply = erply
+        self.request = request
+        self.path = path
+        self.checkpoint_path = checkpoint or path + '.checkpoint'
+        self.per_page = per_page
+        self.restart_on_change = restart_on_change
+        self.format = format
+        self.fields = fields
+        self.kwargs = kwargs
+
+    @property
+    def params(self):
+        return _run_params(self.request, kwargs=self.kwargs, per_page=self.per_page,
+                           format=self.format, fields=self.fields)
+
+    def load_checkpoint(self):
+        """Return saved progress, or `None` when pull has not been started."""
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+        except (IOError, OSError):
+            return None
+        if state.get('params') != self.params:
+            raise ErplyException('Checkpoint {} belongs to a different pull'.format(
+                self.checkpoint_path))
+        return state
+
+    def _save_checkpoint(self, state):
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    def _new_state(self):
+        return dict(params=self.params, page=0, total=None, offset=0, records=0,
+                    columns=None, complete=False)
+
+    def _writer(self, sink, state):
+        if self.format == 'csv':
+            # Resumed file keeps header and columns of the first page
+            return _CSVWriter(sink, state['columns'] or self.fields, self.erply.codec,
+                              header=not state['offset'])
+        return _EXPORT_FORMATS[self.format](sink, self.fields, self.erply.codec)
+
+    def run(self):
+        """Fetch missing pages, returns total number of records written."""
+        state = self.load_checkpoint() or self._new_state()
+        if state['complete']:
+            return state['records']
+
+        kwargs = dict(self.kwargs, recordsOnPage=self.per_page)
+        with io.TextIOWrapper(open(self.path, 'ab'), encoding='utf-8', newline='') as sink:
+            # Drop records written after the last checkpoint
+            sink.buffer.truncate(state['offset'])
+            writer = self._writer(sink, state)
+            while True:
+                response = self.erply.handle_get(self.request, state['page'], None, **kwargs)
+                if state['total'] is not None and response.total != state['total']:
+                    if not self.restart_on_change:
+                        raise ErplyException('Number of {} records changed from {} to {}'.format(
+                            self.request, state['total'], response.total))
+                    logger.info('Number of %s records changed, restarting pull', self.request)
+                    state = self._new_state()
+                    sink.buffer.truncate(0)
+                    writer = self._writer(sink, state)
+                    continue
+                state['total'] = response.total
+
+                if state['page'] < response.pages:
+                    records = response.records.get(state['page']) or []
+                    for record in records:
+                        record = dict(record)
+                        if self.fields:
+                            record = dict((field, record.get(field)) for field in self.fields)
+                        writer.write(record)
+                    sink.flush()
+                    os.fsync(sink.fileno())
+                    state.update(page=state['page'] + 1, offset=sink.buffer.tell(),
+                                 records=state['records'] + len(records),
+                                 columns=writer.fields)
+                state['complete'] = state['page'] >= response.pages
+                self._save_checkpoint(state)
+                if state['complete']:
+                    return state['records']
+
+    def reset(self):
+        """Forget progress and remove written records."""
+        for path in (self.checkpoint_path, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class ErplyFanOutResult(object):
+    """Outcome of a call made for a single account by :class:`ErplyFanOut`."""
+
+    __slots__ = ('auth', 'result', 'error')
+
+    def __init__(self, auth, result=None, error=None):
+        self.auth = auth
+        self.result = result
+        self.error = error
+
+    @property
+    def code(self):
+        return self.auth.code
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _fan_out_call(client_class, client_kwargs, auth, call, args, kwargs):
+    erply = client_class(auth, **client_kwargs)
+    try:
+        if callable(call):
+            return call(erply, *args, **kwargs)
+        response = getattr(erply, call)(*args, **kwargs)
+        if isinstance(response, ErplyCSVResponse):
+            return list(response.iter_rows(cache=False))
+        return list(response.iter_records())
+    finally:
+        erply.close()
+
+
+class ErplyFanOut(object):
+    """Run the same call for many accounts concurrently.
+
+    Every account gets its own client (and thus its own session and quota
+    budget). Failures are collected per account and results are yielded
+    as soon as each account completes::
+
+        fan_out = ErplyFanOut(max_workers=8)
+        for result in fan_out.run(auths, 'getProductStock', warehouseID=1):
+            if result.ok:
+                print (result.code, len(result.result))
+
+    :param max_workers: Number of accounts processed concurrently.
+    :param processes: Use a process pool instead of threads. Calls and
+        client arguments then have to be picklable, shared quota needs a
+        database file.
+    :param client_class: Client class created for each account.
+    :param client_kwargs: Keyword arguments passed to every client.
+    """
+
+    def __init__(self, max_workers=None, processes=False, client_class=None, **client_kwargs):
+        self.max_workers = max_workers
+        self.processes = processes
+        self.client_class = client_class or Erply
+        self.client_kwargs = client_kwargs
+
+    def run(self, auths, call, *args, **kwargs):
+        """Call `call` for every account in `auths`.
+
+        `call` is either name of the request, in which case all records of
+        all pages are returned, or callable receiving client as the first
+        argument.
+        """
+        auths = list(auths)
+        client_kwargs = self.client_kwargs
+        if not self.processes and 'transport' not in client_kwargs:
+            # Threads share one connection pool for all the accounts
+            client_kwargs = dict(client_kwargs, transport=ErplyTransport(
+                pool_connections=max(len(auths), 1)))
+
+        executor_class = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.max_workers) as executor:
+            futures = {}
+            for auth in auths:
+                future = executor.submit(_fan_out_call, self.client_class, client_kwargs,
+                                         auth, call, args, kwargs)
+                futures[future] = auth
+            try:
+                for future in as_completed(futures):
+                    try:
+                        yield ErplyFanOutResult(futures[future], result=future.result())
+                    except Exception as e:
+                        yield ErplyFanOutResult(futures[future], error=e)
+            finally:
+                # Consumer stopped early, skip accounts not started yet
+                for future in futures:
+                    future.cancel()
+                if client_kwargs is not self.client_kwargs:
+                    client_kwargs['transport'].close()
+
+
+def _flatten(record, prefix='', sep='.'):
+    """Flatten nested mappings of `record` into dotted keys."""
+    flat = {}
+    for key, value in record.items():
+        key = prefix + key
+        if isinstance(value, Mapping):
+            flat.update(_flatten(value, key + sep, sep))
+        else:
+            flat[key] = value
+    return flat
+
+
+def _explode(record, field):
+    """Yield copy of `record` for each item of its nested `field` list."""
+    items = record.get(field)
+    if not items:
+        yield dict(record, **{field: None})
+        return
+    for item in items:
+        yield dict(record, **{field: item})
+
+
+class _NDJSONWriter(object):
+
+    def __init__(self, fp, fields, codec):
+        self.fp = fp
+        self.fields = fields
+        self.codec = codec
+
+    def write(self, record):
+        self.fp.write(self.codec.dumps(record))
+        self.fp.write('\n')
+
+    def close(self):
+        pass
+
+
+class _CSVWriter(object):
+
+    def __init__(self, fp, fields, codec, header=True):
+        self.fp = fp
+        self.fields = fields
+        self.codec = codec
+        self.header = header
+        self._writer = None
+
+    def write(self, record):
+        if self._writer is None:
+            # Without projection columns are taken from the first record
+            self.fields = self.fields or list(record)
+            self._writer = csv.DictWriter(self.fp, self.fields, extrasaction='ignore')
+            if self.header:
+                self._writer.writeheader()
+        self._writer.writerow(dict(
+            (k, self.codec.dumps(v) if isinstance(v, (list, dict)) else v)
+            for k, v in record.items()))
+
+    def close(self):
+        pass
+
+
+class _ArrowWriter(object):
+    """Writes records in batches as Parquet or Arrow IPC file, requires `pyarrow`."""
+
+    batch_size = 10000
+
+    def __init__(self, fp, fields, codec, format='parquet'):
+        if _optional_module('pyarrow') is None:
+            raise ImportError('Exporting to {} requires pyarrow'.format(format))
+        self.fp = fp
+        self.format = format
+        self._rows = []
+        self._schema = None
+        self._writer = None
+
+    def write(self, record):
+        self._rows.append(record)
+        if len(self._rows) >= self.batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        if not self._rows:
+            return
+        # Schema is inferred from the first batch
+        table = _optional_module('pyarrow').Table.from_pylist(self._rows, schema=self._schema)
+        self._rows = []
+        if self._writer is None:
+            self._schema = table.schema
+            if self.format == 'parquet':
+                parquet = _optional_module('pyarrow.parquet')
+                self._writer = parquet.ParquetWriter(self.fp, self._schema)
+            else:
+                self._writer = _optional_module('pyarrow.ipc').new_file(self.fp, self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._write_batch()
+        if self._writer is not None:
+            self._writer.close()
+
+
+_EXPORT_FORMATS = {
+    'ndjson': _NDJSONWriter,
+    'csv': _CSVWriter,
+    'parquet': lambda fp, fields, codec: _ArrowWriter(fp, fields, codec, 'parquet'),
+    'arrow': lambda fp, fields, codec: _ArrowWriter(fp, fields, codec, 'arrow'),
+}
+
+
+def export(erply, request, output, format='ndjson', fields=None, flatten=False,
+           explode=None, prefetch=0, bulk=False, **kwargs):
+    """Stream all records of `request` to `output` page by page.
+
+    Only `prefetch + 1` pages are kept in memory at a time. Returns number
+    of written records.
+
+    :param output: File name or file object, binary for `parquet` and
+        `arrow` formats.
+    :param format: One of `ndjson`, `csv`, `parquet` or `arrow`.
+    :param fields: Names of fields to export, dotted names when `flatten`
+        is used.
+    :param flatten: Flatten nested objects into dotted field names.
+    :param explode: Name of nested list (eg. `rows` of sales documents),
+        writes one record per item of the list.
+    :param bulk: Fetch pages with bulk requests, see
+        :meth:`ErplyResponse.iter_records`.
+    """
+    if request not in erply.ERPLY_GET:
+        raise ValueError('Request {} can not be exported'.format(request))
+    if format not in _EXPORT_FORMATS:
+        raise ValueError('Unknown export format {}'.format(format))
+
+    response = getattr(erply, request)(**kwargs)
+    response.max_pages = prefetch + 1
+
+    fp = output
+    if isinstance(output, str):
+        fp = open(output, 'wb') if format in ('parquet', 'arrow') else open(output, 'w', newline='')
+    writer = _EXPORT_FORMATS[format](fp, fields, erply.codec)
+
+    count = 0
+    try:
+        for record in response.iter_records(prefetch, bulk=bulk):
+            record = dict(record)
+            for row in _explode(record, explode) if explode else (record,):
+                if flatten:
+                    row = _flatten(row)
+                if fields:
+                    row = dict((field, row.get(field)) for field in fields)
+                writer.write(row)
+                count += 1
+        writer.close()
+    finally:
+        if fp is not output:
+            fp.close()
+    return count
+
+
+def main(argv=None):
+    """Command line entry point of `erply-export`."""
+    parser = argparse.ArgumentParser(
+        description='Export records of Erply API request.',
+        epilog='Credentials default to ERPLY_CUSTOMER_CODE, ERPLY_USERNAME '
+               'and ERPLY_PASSWORD environment variables.')
+    parser.add_argument('request', help='API request, eg. getProducts')
+    parser.add_argument('params', nargs='*', metavar='name=value',
+                        help='Parameters of the request')
+    parser.add_argument('-o', '--output', default='-', help='Output file, defaults to stdout')
+    parser.add_argument('-f', '--format', default='ndjson', choices=sorted(_EXPORT_FORMATS))
+    parser.add_argument('--fields', help='Comma separated list of fields to export')
+    parser.add_argument('--flatten', action='store_true', help='Flatten nested objects')
+    parser.add_argument('--explode', help='Write one record per item of nested list')
+    parser.add_argument('--prefetch', type=int, default=0, help='Pages to fetch ahead')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Fetch pages with bulk requests')
+    parser.add_argument('--code', default=os.environ.get('ERPLY_CUSTOMER_CODE'))
+    parser.add_argument('--username', default=os.environ.get('ERPLY_USERNAME'))
+    parser.add_argument('--password', default=os.environ.get('ERPLY_PASSWORD'))
+    args = parser.parse_args(argv)
+
+    if not (args.code and args.username and args.password):
+        parser.error('Erply credentials are required')
+    params = dict(param.split('=', 1) for param in args.params)
+    output = args.output
+    if output == '-':
+        output = sys.stdout.buffer if args.format in ('parquet', 'arrow') else sys.stdout
+
+    with Erply(ErplyAuth(args.code, args.username, args.password), wait_on_limit=True) as erply:
+        count = export(erply, args.request, output, args.format,
+                       fields=args.fields.split(',') if args.fields else None,
+                       flatten=args.flatten, explode=args.explode,
+                       prefetch=args.prefetch, bulk=args.bulk, **params)
+    logger.info('Exported %d records', count)
+    return 0
+
+
+class _SyncOnly(object):
+    """Hides method of the sync client from its asyncio subclass."""
+
+    def __get__(self, instance, owner):
+        raise AttributeError
+
+
+class _BufferedResponse(object):
+    """Fully read HTTP response returned by :class:`AsyncErplyTransport`."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+class AsyncErplyTransport(object):
+    """Pooled keep-alive asyncio HTTP transport, requires `aiohttp`.
+
+    :param limit: Total number of simultaneous connections.
+    :param limit_per_host: Maximum number of connections per host.
+    :param keepalive_timeout: Seconds idle connections are kept open.
+    :param session: Optional pre-configured :class:`aiohttp.ClientSession`.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=15,
+                 session=None):
+        if session is None and _optional_module('aiohttp') is None:
+            raise ImportError('AsyncErplyTransport requires aiohttp')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._session = session
+
+    @property
+    def session(self):
+        # Session has to be created inside running event loop
+        if self._session is None:
+            aiohttp = _optional_module('aiohttp')
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    @staticmethod
+    def _client_timeout(timeout):
+        if timeout is None:
+            return None
+        aiohttp = _optional_module('aiohttp')
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def post(self, url, data=None, headers=None, timeout=None):
+        # Errors are raised as their `requests` counterparts, so retry
+        # handling is shared with the synchronous client
+        aiohttp = _optional_module('aiohttp')
+        try:
+            async with self.session.post(url, data=data, headers=headers,
+                                         timeout=self._client_timeout(timeout)) as resp:
+                return _BufferedResponse(resp.status, await resp.read())
+        except aiohttp.ClientConnectorError as e:
+            # Same shape as failed connection of `requests`
+            raise requests.exceptions.ConnectionError(NewConnectionError(None, str(e)))
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.RequestException(e)
+
+    async def iter_content(self, url, chunk_size=64 * 1024, timeout=None):
+        """Yield body of `url` in chunks as they arrive."""
+        async with self.session.get(url, timeout=self._client_timeout(timeout)) as resp:
+            if resp.status != requests.codes.ok:
+                raise ValueError('Request failed with error {}'.format(resp.status))
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncErply(Erply):
+    """Asyncio version of :class:`Erply` client.
+
+    Exposes the same dynamic methods as :class:`Erply`, which have to be
+    awaited::
+
+        async with AsyncErply(auth) as erply:
+            products, customers = await asyncio.gather(
+                erply.getProducts(), erply.getCustomers())
+
+    Automatic batching, background writer, batched lookups and bulk
+    pagination are only available with the sync client.
+    """
+
+    def __init__(self, auth, erply_api_url=None, wait_on_limit=False,
+                 transport=None, quota=None, priority=ErplyQuota.PRIORITY_NORMAL,
+                 session_store=None, cache=None, compact_records=False, max_pages=None,
+                 codec=None, lazy_records=False, observers=None,
+                 timeout=(10, 300), retry=None):
+        super(AsyncErply, self).__init__(
+            auth, erply_api_url, wait_on_limit,
+            transport=transport or AsyncErplyTransport(),
+            quota=quota, priority=priority,
+            session_store=session_store, cache=cache,
+            compact_records=compact_records, max_pages=max_pages,
+            codec=codec, lazy_records=lazy_records, observers=observers,
+            timeout=timeout, retry=retry)
+        self._owns_transport = transport is None
+        self._auth_lock = None
+        self._refresh_task = None
+
+    async def close(self):
+        """Release pooled connections unless the transport is shared."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self._owns_transport:
+            await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self):
+        raise TypeError('Use `await get_session()` with AsyncErply')
+
+    def _has_session(self):
+        return self._key and (self._key_expires is None or self._key_expires > time())
+
+    def _get_auth_lock(self):
+        # Lock has to be created inside running event loop
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        return self._auth_lock
+
+    async def get_session(self):
+        if not self._has_session():
+            async with self._get_auth_lock():
+                # Only first coroutine authenticates, others reuse its key
+                if not self._has_session():
+                    store = self.session_store
+                    session = store.get(self._session_id) if store else None
+                    if session and session[1] > time():
+                        self._use_session(session)
+                    elif store:
+                        self._use_session(self._new_session(
+                            await self._handle_get('verifyUser', 0, **self.auth.data)))
+                    else:
+                        self._key = self._session_key(
+                            await self._handle_get('verifyUser', 0, **self.auth.data))
+        key = self._key
+        if (self._key_refresh_at or float('inf')) <= time():
+            self._refresh_in_background()
+        return key
+
+    async def _refresh_session(self):
+        try:
+            async with self._get_auth_lock():
+                store = self.session_store
+                session = store.get(self._session_id)
+                if not session or session[2] <= time():
+                    session = self._new_session(
+                        await self._handle_get('verifyUser', 0, **self.auth.data))
+                self._use_session(session)
+        except Exception:
+            logger.exception('Refreshing Erply session failed')
+
+    def _refresh_in_background(self):
+        # Current key is used until the task has fetched a new one
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_session())
+
+    async def get_payload(self):
+        return dict(sessionKey=await self.get_session(), **self._payload)
+
+    async def _reserve_quota(self):
+        while True:
+            wait = self._quota_wait()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _erply_query(self, data, _initial_response=None, _batch_size=None, _idempotent=None):
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if _idempotent is None:
+            _idempotent = self._is_idempotent(data)
+
+        logger.debug('Erply request %s', data.get('request'))
+        await self._reserve_quota()
+        attempt = 0
+        while True:
+            timeout = self._request_timeout()
+            started = monotonic()
+            try:
+                resp, error = await self.transport.post(self.api_url, data=data, headers=headers,
+                                                        timeout=timeout), None
+            except requests.exceptions.RequestException as e:
+                resp, error = None, e
+            delay = self._retry_delay(data.get('request'), resp, error, attempt, _idempotent)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        session_key = data.get('sessionKey')
+        data = self._decode_response(resp, data, monotonic() - started, _batch_size)
+        wait = self._check_status(data, session_key)
+        if wait is None:
+            return False, data
+
+        if wait:
+            await asyncio.sleep(wait)
+        return True, None
+
+    async def handle_csv(self, request, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return await self.handle_csv(request, *args, **kwargs)
+
+        data = dict(request=request.replace('CSV', ''), responseType='CSV')
+        data.update(await self.get_payload())
+        data.update(**kwargs)
+
+        retry, parsed_data = await self._erply_query(data)
+        if retry:
+            return await self.handle_csv(request, *args, **kwargs)
+
+        return AsyncErplyCSVResponse(self, parsed_data)
+
+    def handle_get(self, request, _page=None, _response=None, *args, **kwargs):
+        # Bulk request parts are built synchronously
+        if kwargs.get('_is_bulk'):
+            return super(AsyncErply, self).handle_get(request, _page, _response, *args, **kwargs)
+        kwargs.pop('_is_bulk', None)
+        return self._handle_get(request, _page, _response, *args, **kwargs)
+
+    async def _handle_get(self, request, _page=None, _response=None, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return await self._handle_get(request, _page, _response, *args, **kwargs)
+
+        data = self._page_params(request, kwargs, _page)
+
+        parsed_data = self._cache_get(request, data)
+        if parsed_data is None:
+            params = data.copy()
+            data.update(request=request)
+            data.update(await self.get_payload() if request != 'verifyUser' else self._payload)
+
+            retry, parsed_data = await self._erply_query(data)
+
+            # Retry request in case of token expiration
+            if retry:
+                return await self._handle_get(request, _page, _response, *args, **kwargs)
+            self._cache_set(request, params, parsed_data)
+
+        response = AsyncErplyResponse(self, parsed_data, request, _page, *args, **kwargs)
+        if _response:
+            _response.populate_page(_payload_records(parsed_data), _page)
+        return response
+
+    def handle_post(self, request, *args, **kwargs):
+        if kwargs.get('_is_bulk'):
+            return super(AsyncErply, self).handle_post(request, *args, **kwargs)
+        kwargs.pop('_is_bulk', None)
+        return self._handle_post(request, *args, **kwargs)
+
+    async def _handle_post(self, request, *args, **kwargs):
+        options = _pop_call_options(kwargs)
+        if any(options):
+            with _call_options(*options):
+                return await self._handle_post(request, *args, **kwargs)
+
+        data = kwargs.copy()
+        data.update(request=request)
+        data.update(await self.get_payload())
+
+        retry, parsed_data = await self._erply_query(data)
+
+        # Retry request in case of token expiration
+        if retry:
+            return await self._handle_post(request, *args, **kwargs)
+
+        if self.cache is not None:
+            self.cache.invalidate_for(request)
+        return AsyncErplyResponse(self, parsed_data, request, *args, **kwargs)
+
+    # Thread based helpers are only available with the sync client
+    batch = writer = loader = _SyncOnly()
+
+    async def handle_bulk(self, _requests):
+        size, idempotent = self._bulk_options(_requests)
+        while True:
+            retry, parsed_data = await self._erply_query(
+                dict(await self.get_payload(), requests=_requests),
+                _batch_size=size, _idempotent=idempotent)
+            if not retry:
+                return ErplyBulkResponse(self, parsed_data)
+
+
+class AsyncErplyResponse(ErplyResponse):
+    """Paginated response of :class:`AsyncErply`.
+
+    Pages are fetched with `await response.get_page(n)` or by iterating
+    with `async for page in response`.
+    """
+
+    fetch_pages = _SyncOnly()
+
+    async def fetch_records(self, page):
+        with _call_options(deadline=self.deadline):
+            if self.page_sizer is None:
+                response = await self.erply.handle_get(self.request, _page=page, _response=self,
+                                                       **self.kwargs)
+                return response.records.get(page)
+
+            records = []
+            for offset, size in self._sub_pages(page):
+                _last_response.set(None)
+                response = await self.erply.handle_get(self.request, offset // size,
+                                                       **dict(self.kwargs, recordsOnPage=size))
+                records.extend(self._sub_page_records(response, offset // size))
+            return self.populate_page(records, page)
+
+    async def get_page(self, key):
+        if self.per_page * key >= self.total:
+            raise IndexError
+        if key not in self.records:
+            await self.fetch_records(key)
+        return self.records[key]
+
+    def __getitem__(self, key):
+        if key not in self.records:
+            raise LookupError('Page {} is not fetched, use `await get_page()`'.format(key))
+        return self.records[key]
+
+    def __iter__(self):
+        raise TypeError('Use `async for` with AsyncErplyResponse')
+
+    async def __aiter__(self):
+        page = 0
+        while self.per_page * page < self.total:
+            yield await self.get_page(page)
+            page += 1
+
+    async def iter_records(self, prefetch=0):
+        pending = {}
+        try:
+            for page in range(self.pages):
+                records = None if page in pending else self.records.get(page)
+                first = page if records is None else page + 1
+                for ahead in range(first, min(page + prefetch + 1, self.pages)):
+                    if ahead not in pending and ahead not in self.records:
+                        pending[ahead] = asyncio.ensure_future(self.fetch_records(ahead))
+                if page in pending:
+                    records = await pending.pop(page)
+                for record in records if records is not None else await self.get_page(page):
+                    yield record
+        finally:
+            for task in pending.values():
+                task.cancel()
+
+
+class AsyncErplyCSVResponse(ErplyCSVResponse):
+    """CSV report of :class:`AsyncErply`, iterate with `async for row in response`."""
+
+    @property
+    def records(self):
+        raise AttributeError('Use `async for` with AsyncErplyCSVResponse')
+
+    def __aiter__(self):
+        return self.iter_rows()
+
+    async def iter_rows(self, skip_header=0, skip_footer=0, refresh=False, cache=True):
+        skipped = 0
+        lookahead = deque()
+        async for row in self._iter_rows(refresh, cache):
+            if skipped < skip_header:
+                skipped += 1
+                continue
+            lookahead.append(row)
+            if len(lookahead) > skip_footer:
+                yield lookahead.popleft()
+
+    async def iter_batches(self, batch_size=10000, schema=None, header_row=None,
+                           skip_footer=None, use_numpy=None, refresh=False, cache=True):
+        columns = _ReportColumns(batch_size, schema, header_row, skip_footer, use_numpy)
+        async for row in self._iter_rows(refresh, cache):
+            for batch in columns.feed(row):
+                yield batch
+        for batch in columns.close():
+            yield batch
+
+    async def _iter_rows(self, refresh, cache):
+        if self._spool is not None and not refresh:
+            feed = _CSVFeed(self._spool_encoding, delimiter=';')
+            for chunk in self._replay_chunks():
+                for row in feed.feed(chunk):
+                    yield row
+        else:
+            encoding = self.encoding or 'utf-8'
+            spool = self._new_spool(cache)
+            feed = _CSVFeed(encoding, delimiter=';')
+            timeout = self.erply._request_timeout()
+            try:
+                async for chunk in self.erply.transport.iter_content(self.url, self.chunk_size,
+                                                                      timeout):
+                    if spool is not None:
+                        spool.write(chunk)
+                    for row in feed.feed(chunk):
+                        yield row
+                if spool is not None:
+                    self._publish_spool(spool, encoding)
+            finally:
+                self._release_spool(spool)
+        for row in feed.close():
+            yield row
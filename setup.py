@@ -4,5 +4,6 @@ from setuptools import setup
 setup(
     name='ErplyAPI',
     install_requires=['requests[security]>=2.6.0'],
+    extras_require={'async': ['aiohttp>=3.6'], 'parquet': ['pyarrow>=7'], 'numpy': ['numpy>=1.16']},
     py_modules = ['erply_api']
 )
@@ -1,10 +1,32 @@
+import asyncio
+import io
 import json
 import mock
+import os
+import pickle
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+import requests
 import requests_mock
-from datetime import datetime
+import socket
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from datetime import date, datetime
+from time import sleep, time
 
-from erply_api import Erply, ErplyAuth, ErplyAPILimitException
+from erply_api import (
+    AsyncErply, Erply, ErplyAuth, ErplyAPILimitException, ErplyBulkRequest, ErplyCache, ErplyException,
+    ErplyFanOut, ErplyJSONCodec, ErplyPull, ErplyStats,
+    ErplyMemoryCacheBackend, ErplyRecordPage, ErplySQLiteCacheBackend, ErplySync,
+    ErplyQuota, ErplySessionStore, ErplySQLiteSessionStore, ErplyTimeoutException,
+    ErplyTransport, AsyncErplyTransport, export,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 try:
     # Python 3
@@ -33,6 +55,86 @@ class TestErply(unittest.TestCase):
 
         assert erply.api_url == url
 
+    def test_erply_shared_transport(self):
+        transport = ErplyTransport(pool_maxsize=4)
+        transport.close = mock.Mock()
+
+        first = Erply(self._auth, transport=transport)
+        second = Erply(self._auth, transport=transport)
+        assert first.transport is second.transport
+
+        adapter = transport.session.get_adapter(first.api_url)
+        assert adapter._pool_maxsize == 4
+
+        # Shared transport is not closed by the clients using it
+        first.close()
+        second.close()
+        transport.close.assert_not_called()
+
+        with Erply(self._auth) as erply:
+            erply.transport.close = mock.Mock()
+        erply.transport.close.assert_called_once_with()
+
+    def test_quota_priorities(self):
+        quota = ErplyQuota(limit=10)
+
+        low = [quota.acquire('eng', ErplyQuota.PRIORITY_LOW) for _ in range(8)]
+        # 30% of the budget is reserved for higher priorities
+        assert low[:7] == [0] * 7
+        assert low[7] > 0
+
+        assert quota.acquire('eng', ErplyQuota.PRIORITY_HIGH) == 0
+        assert quota.remaining('eng') == 2
+        # Budgets are kept per client code
+        assert quota.remaining('other') == 10
+
+        quota.exhaust('eng')
+        assert quota.acquire('eng', ErplyQuota.PRIORITY_HIGH) > 0
+
+    def test_quota_shared_between_processes(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        first = ErplyQuota(path, limit=3)
+        second = ErplyQuota(path, limit=3)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        first.acquire('eng', ErplyQuota.PRIORITY_HIGH)
+        assert second.remaining('eng') == 2
+
+        # Passed to another process, quota reopens the same database
+        third = pickle.loads(pickle.dumps(first))
+        self.addCleanup(third.close)
+        assert third.remaining('eng') == 2
+
+        with self.assertRaises(TypeError):
+            pickle.dumps(ErplyQuota())
+
+    def test_cache_counters_thread_safe(self):
+        cache = ErplyCache()
+        cache.set('getWarehouses', 'eng', {}, {'records': []})
+
+        def lookup(_):
+            for _ in range(500):
+                cache.get('getWarehouses', 'eng', {})
+                cache.get('getWarehouses', 'other', {})
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lookup, range(8)))
+        assert (cache.hits, cache.misses) == (4000, 4000)
+
+    def test_quota_exceeded(self):
+        quota = ErplyQuota(limit=1)
+        quota.exhaust(self.CUSTOMER_CODE)
+        erply = Erply(self._auth, quota=quota)
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+        erply.transport.post = mock.Mock()
+
+        with self.assertRaises(ErplyAPILimitException):
+            erply.getProducts()
+        erply.transport.post.assert_not_called()
+
 
 @requests_mock.Mocker()
 class TestErplyIntegration(unittest.TestCase):
@@ -94,6 +196,785 @@ class TestErplyIntegration(unittest.TestCase):
         assert qs.get('recordsOnPage') == ['1']
         assert qs.get('pageNo') == ['2']
 
+    def test_prefetch_records(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]})
+
+        def customers(request, context):
+            qs = parse_qs(request.text)
+            if qs['request'] == ['verifyUser']:
+                return _auth_response
+            page = int(qs.get('pageNo', ['1'])[0])
+            return json.dumps({"status":{"request":"getCustomers","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":total[0],"recordsInResponse":1},"records":[{"id":page}]})
+
+        total = [5]
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=customers)
+
+        r = self.erply.getCustomers(recordsOnPage=1)
+        assert r.pages == 5
+
+        records = list(r.iter_records(prefetch=3))
+        assert [c['id'] for c in records] == [1, 2, 3, 4, 5]
+        # auth + 5 pages
+        assert m.call_count == 6
+
+        # Prefetched pages are not fetched again when they do not fit in
+        # `max_pages`
+        total[0] = 40
+        self.erply.max_pages = 2
+        r = self.erply.getCustomers(recordsOnPage=1)
+        records = list(r.iter_records(prefetch=4))
+        assert [c['id'] for c in records] == list(range(1, 41))
+        # 40 pages, each fetched once
+        assert m.call_count == 6 + 40
+
+    def test_csv_report_stream(self, m):
+        _report_status = json.dumps({'status': {'generationTime': 0.074487924575806, 'recordsInResponse': 1, 'requestUnixTime': 1471021437, 'responseStatus': 'ok', 'errorCode': 0, 'request': 'getSalesReport', 'recordsTotal': 1}, 'records': [{'reportLink': 'https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv'}]})
+        _report = u'Sales report;\r\nProduct;Amount\r\n"Multi\r\nline";1\r\nK\u00fcpsis;2\r\nTotal;3\r\n'.encode('utf-8')
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_report_status)
+        m.get('https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv', content=_report)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        report = self.erply.getSalesReport(reportType='SALES_BY_DATE')
+        self.addCleanup(report.close)
+        report.chunk_size = 5
+        report.encoding = 'utf-8'
+
+        rows = list(report.iter_rows(skip_header=2, skip_footer=1))
+        assert rows == [['Multi\r\nline', '1'], [u'K\u00fcpsis', '2']]
+        assert m.call_count == 2
+
+        # Cached report is not downloaded again unless asked
+        assert len(list(report.records)) == 5
+        assert m.call_count == 2
+        assert len(list(report.iter_rows(refresh=True))) == 5
+        assert m.call_count == 3
+
+        # Interleaved downloads write their own copies of the report
+        first = report.iter_rows(refresh=True)
+        next(first)
+        second = report.iter_rows(refresh=True)
+        next(second)
+        assert len(list(first)) == 4
+        assert len(list(second)) == 4
+        cached = report.iter_rows()
+        next(cached)
+        report.close()
+        assert len(list(cached)) == 4
+        assert m.call_count == 5
+
+    def test_csv_report_columns(self, m):
+        _report_status = json.dumps({'status': {'generationTime': 0.074487924575806, 'recordsInResponse': 1, 'requestUnixTime': 1471021437, 'responseStatus': 'ok', 'errorCode': 0, 'request': 'getSalesReport', 'recordsTotal': 1}, 'records': [{'reportLink': 'https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv'}]})
+        _report = (u'Sales report;;\r\nPeriod;2016-06-01;2016-06-30\r\n;;\r\nDate;Product;Amount\r\n'
+                   u'2016-06-01;K\u00fcpsis;1.5\r\n2016-06-02;Sai;2\r\n2016-06-03;Sai;\r\n;;\r\nTotal;;3.5\r\n').encode('utf-8')
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_report_status)
+        m.get('https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv', content=_report)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        report = self.erply.getSalesReport(reportType='SALES_BY_DATE')
+        self.addCleanup(report.close)
+        report.encoding = 'utf-8'
+
+        # Title and summary rows around the table are detected
+        first, second = list(report.iter_batches(batch_size=2, use_numpy=False))
+        assert list(first) == ['Date', 'Product', 'Amount']
+        assert first['Date'] == [date(2016, 6, 1), date(2016, 6, 2)]
+        assert first['Product'] == [u'K\u00fcpsis', 'Sai']
+        assert first['Amount'].tolist() == [1.5, 2.0]
+        assert second['Amount'].typecode == 'd'
+        assert len(second['Date']) == 1
+
+        batch, = report.iter_batches(schema={'Date': 'str', 'Amount': 'float'}, use_numpy=False)
+        assert batch['Date'] == ['2016-06-01', '2016-06-02', '2016-06-03']
+        assert sum(v for v in batch['Amount'] if v == v) == 3.5
+
+    def test_csv_report_columns_summary(self, m):
+        _report_status = json.dumps({'status': {'generationTime': 0.074487924575806, 'recordsInResponse': 1, 'requestUnixTime': 1471021437, 'responseStatus': 'ok', 'errorCode': 0, 'request': 'getSalesReport', 'recordsTotal': 1}, 'records': [{'reportLink': 'https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv'}]})
+        _report = u'Sales report;\r\nProduct;Amount\r\n"Multi\r\nline";1\r\nK\u00fcpsis;2\r\nTotal;3\r\n'.encode('utf-8')
+        _dated = u'Date;Amount\r\n2016-06-01;1\r\n2016-06-02;2\r\nSum;3\r\n'.encode('utf-8')
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_report_status)
+        m.get('https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv', [
+            {'content': _report}, {'content': _dated}])
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        report = self.erply.getSalesReport(reportType='SALES_BY_DATE')
+        self.addCleanup(report.close)
+        report.encoding = 'utf-8'
+
+        # Summary row of the same width is not read as data
+        batch, = report.iter_batches(use_numpy=False)
+        assert batch['Product'] == ['Multi\r\nline', u'K\u00fcpsis']
+        assert sum(batch['Amount']) == 3
+
+        # Summary label in typed first column ends the table
+        batches = list(report.iter_batches(batch_size=2, use_numpy=False, refresh=True))
+        assert [len(b['Date']) for b in batches] == [2]
+        assert sum(batches[0]['Amount']) == 3
+
+    def test_csv_report_columns_widening(self, m):
+        _report_status = json.dumps({'status': {'generationTime': 0.074487924575806, 'recordsInResponse': 1, 'requestUnixTime': 1471021437, 'responseStatus': 'ok', 'errorCode': 0, 'request': 'getSalesReport', 'recordsTotal': 1}, 'records': [{'reportLink': 'https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv'}]})
+        _report = u'Product;Qty\r\nA;1\r\nB;2\r\nC;2.5\r\nD;3\r\nE;n/a\r\n'.encode('utf-8')
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_report_status)
+        m.get('https://t1.erply.com/actualreports/123_9aa0b4882da49edb7684e9e5e0144c65.csv', content=_report)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        report = self.erply.getSalesReport(reportType='SALES_BY_DATE')
+        self.addCleanup(report.close)
+        report.encoding = 'utf-8'
+
+        # Values not fitting inferred type widen it instead of ending the table
+        first, second, third = report.iter_batches(batch_size=2, use_numpy=False)
+        assert first['Qty'].tolist() == [1, 2]
+        assert second['Qty'].typecode == 'd'
+        assert second['Qty'].tolist() == [2.5, 3.0]
+        assert third['Qty'] == ['n/a']
+        assert third['Product'] == ['E']
+
+        # Values not fitting given type are not skipped
+        with self.assertRaises(ValueError):
+            list(report.iter_batches(schema={'Qty': 'int'}, use_numpy=False))
+
+    def test_batch_requests(self, m):
+        def bulk(request, context):
+            qs = parse_qs(request.text)
+            _requests = json.loads(qs['requests'][0])
+            items = []
+            # Responses are matched by requestID, not by position
+            for r in reversed(_requests):
+                if r.get('productID') == 3:
+                    status = {'requestName': r['requestName'], 'requestID': r['requestID'], 'responseStatus': 'error', 'errorCode': 1011, 'errorField': 'productID'}
+                    items.append({'status': status, 'records': None})
+                else:
+                    status = {'requestName': r['requestName'], 'requestID': r['requestID'], 'responseStatus': 'ok', 'errorCode': 0, 'recordsTotal': 1}
+                    items.append({'status': status, 'records': [{'productID': r['productID']}]})
+            return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=bulk)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        with self.erply.batch(max_size=2):
+            first = self.erply.getProducts(productID=1)
+            saved = self.erply.saveProduct(productID=2, name='Foo')
+            failed = self.erply.getProducts(productID=3)
+            assert not first.done()
+
+        # 3 calls split into 2 bulk requests
+        assert m.call_count == 2
+        assert len(json.loads(parse_qs(m.request_history[0].text)['requests'][0])) == 2
+
+        assert first.result().fetchone() == {'productID': 1}
+        assert saved.result().records[0] == [{'productID': 2}]
+        with self.assertRaises(ErplyException):
+            failed.result()
+
+    def test_batch_internal_calls(self, m):
+        _auth_response = {"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]}
+        _sexp_response = {"status":{"request":"getProducts","requestUnixTime":1470474000,"responseStatus":"error","errorCode":1054,"recordsTotal":0,"recordsInResponse":0}}
+        expired = []
+
+        def respond(request, context):
+            qs = parse_qs(request.text)
+            if qs.get('request') == ['verifyUser']:
+                return json.dumps(_auth_response)
+            if expired:
+                return json.dumps(expired.pop())
+            if 'requests' in qs:
+                items = [{'status': {'requestID': r['requestID'], 'responseStatus': 'ok', 'errorCode': 0, 'recordsTotal': 1},
+                          'records': [{'productID': r['productID']}]} for r in json.loads(qs['requests'][0])]
+                return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+            return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":2,"recordsInResponse":1},"records":[{"productID": int(qs.get('pageNo', ['1'])[0])}]})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=respond)
+
+        # Authentication of inner batch is not added to the outer one
+        with self.erply.batch():
+            with self.erply.batch():
+                inner = self.erply.getProducts(productID=1)
+        assert inner.result().fetchone() == {'productID': 1}
+
+        # Re-sent request of expired session is not added to the batch
+        r = self.erply.getProducts(recordsOnPage=1)
+        expired.append(_sexp_response)
+        with self.erply.batch():
+            assert r[1] == [{'productID': 2}]
+        assert not expired
+
+    def test_background_writer(self, m):
+        def bulk(request, context):
+            _requests = json.loads(parse_qs(request.text)['requests'][0])
+            items = []
+            for r in _requests:
+                status = {'requestName': r['requestName'], 'requestID': r['requestID'], 'responseStatus': 'ok', 'errorCode': 0, 'recordsTotal': 1}
+                if r['productID'] == '3':
+                    status.update(responseStatus='error', errorCode=1011)
+                items.append({'status': status, 'records': [{'productID': int(r['productID'])}]})
+            return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=bulk)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        with self.erply.writer(max_size=2, max_delay=60) as writer:
+            with self.assertRaises(ValueError):
+                writer.add('getProducts')
+            saved = [writer.saveProduct(productID=str(n)) for n in range(1, 6)]
+            # Last incomplete bulk is sent on flush instead of waiting for delay
+            writer.flush()
+            assert all(f.done() for f in saved)
+            assert m.call_count == 3
+
+            late = writer.saveProduct(productID='6')
+
+        # Closing sends remaining writes
+        assert m.call_count == 4
+        assert late.result().records[0] == [{'productID': 6}]
+        assert saved[0].result().records[0] == [{'productID': 1}]
+        with self.assertRaises(ErplyException):
+            saved[2].result()
+        with self.assertRaises(RuntimeError):
+            writer.saveProduct(productID='7')
+
+    def test_loader(self, m):
+        def products(request, context):
+            qs = parse_qs(request.text)
+            if 'requests' in qs:
+                items = []
+                for r in json.loads(qs['requests'][0]):
+                    status = {'requestName': r['requestName'], 'requestID': r['requestID'], 'responseStatus': 'ok', 'errorCode': 0, 'recordsTotal': 1}
+                    items.append({'status': status, 'records': [{'warehouseID': r['warehouseID']}]})
+                return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+            ids = [i for i in qs['productIDs'][0].split(',') if i != '3']
+            return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":len(ids),"recordsInResponse":len(ids)},"records":[{'productID': int(i)} for i in ids]})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=products)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        loader = self.erply.loader('getProducts', window=None)
+        first, second, missing = loader.load(1), loader.load(2), loader.load(3)
+        assert loader.load('1') is first
+        assert not first.done()
+        loader.dispatch()
+
+        # Deduplicated IDs are fetched with single list filter request
+        assert m.call_count == 1
+        assert parse_qs(m.request_history[0].text)['productIDs'] == ['1,2,3']
+        assert first.result() == {'productID': 1}
+        assert second.result() == {'productID': 2}
+        assert missing.result() is None
+        # Cached lookups do not make requests
+        assert loader.load_many([2, 1]) == [{'productID': 2}, {'productID': 1}]
+        assert m.call_count == 1
+
+        # Requests without list filter are sent in bulk once window passes
+        warehouses = self.erply.loader('getWarehouses', window=0.01)
+        first, second = warehouses.load(1), warehouses.load(2)
+        assert first.result(timeout=5) == {'warehouseID': '1'}
+        assert second.result() == {'warehouseID': '2'}
+        assert m.call_count == 2
+
+    def test_thread_safety(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]})
+        _product = json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"productID":1}]})
+
+        def slow(request, context):
+            # Keep request in flight while other threads make the same call
+            sleep(0.2)
+            return _auth_response if 'verifyUser' in request.text else _product
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=slow)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: self.erply.getProducts(productID=1), range(5)))
+
+        # Single authentication and single shared request
+        assert m.call_count == 2
+        assert all(r.fetchone() == {'productID': 1} for r in results)
+
+        # Bulk variant is not cached under the plain name
+        assert isinstance(self.erply.getProducts_bulk(productID=1), dict)
+        assert self.erply.getProducts(productID=1).fetchone() == {'productID': 1}
+
+    def test_session_store(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]})
+        _ware_response = json.dumps({"status":{"request":"getWarehouses","requestUnixTime":1470473993,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"warehouseID":"1"}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), [
+            {'text': _auth_response},
+            {'text': _ware_response},
+            {'text': _ware_response},
+        ])
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        store = ErplySQLiteSessionStore(path)
+        self.addCleanup(store.close)
+
+        Erply(self._auth, session_store=store).getWarehouses()
+        assert m.call_count == 2
+
+        # Session is reused by other clients and after restarts
+        restarted = ErplySQLiteSessionStore(path)
+        self.addCleanup(restarted.close)
+        Erply(self._auth, session_store=restarted).getWarehouses()
+        assert m.call_count == 3
+        key, expires, refresh_at = restarted.get('eng:demo')
+        assert key == 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+        assert expires - refresh_at == 60
+
+    def test_session_refresh_in_background(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"new","sessionLength":3600}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_auth_response)
+
+        store = ErplySessionStore()
+        store.set('eng:demo', ('old', time() + 30, time() - 1))
+        erply = Erply(self._auth, session_store=store)
+
+        # Current key is used while new one is requested in the background
+        assert erply.session == 'old'
+        erply._refresh_thread.join()
+        assert m.call_count == 1
+        assert erply.session == 'new'
+        assert store.get('eng:demo')[0] == 'new'
+
+    def test_session_expiry_during_background_refresh(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"new","sessionLength":3600}]})
+        _serr_response = json.dumps({"status":{"request":"getProducts","requestUnixTime":1470474000,"responseStatus":"error","errorCode":1054,"recordsTotal":0,"recordsInResponse":0}})
+        _product = json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"productID":1}]})
+
+        def respond(request, context):
+            qs = parse_qs(request.text)
+            if qs['request'] == ['verifyUser']:
+                # Refresh holds the store lock while old key gets rejected
+                sleep(0.3)
+                return _auth_response
+            return _serr_response if qs['sessionKey'] == ['old'] else _product
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=respond)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        store = ErplySQLiteSessionStore(path)
+        self.addCleanup(store.close)
+        store.set('eng:demo', ('old', time() + 30, time() - 1))
+        erply = Erply(self._auth, session_store=store)
+
+        results = []
+        worker = threading.Thread(target=lambda: results.append(erply.getProducts()))
+        worker.daemon = True
+        worker.start()
+        worker.join(5)
+        assert not worker.is_alive(), 'Session expiry deadlocked with background refresh'
+        assert results[0].fetchone() == {'productID': 1}
+        erply._refresh_thread.join(5)
+        assert store.get('eng:demo')[0] == 'new'
+
+    def test_response_cache(self, m):
+        _ware_response = json.dumps({"status":{"request":"getWarehouses","requestUnixTime":1470473993,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"warehouseID":"1"}]})
+        _save_response = json.dumps({"status":{"request":"saveProduct","requestUnixTime":1470473993,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"productID":1}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_ware_response)
+        cache = ErplyCache(ttls={'getWarehouses': 60, 'getProducts': 60})
+        erply = Erply(self._auth, cache=cache)
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        erply.getWarehouses(warehouseID=1)
+        # Parameters are normalised
+        assert erply.getWarehouses(warehouseID='1').records[0] == [{"warehouseID": "1"}]
+        assert m.call_count == 1
+        erply.getWarehouses(warehouseID=2)
+        assert m.call_count == 2
+        assert cache.stats['hits'] == 1
+        assert cache.stats['misses'] == 2
+
+        erply.getProducts()
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_save_response)
+        erply.saveProduct(productID=1)
+        # Write request invalidated cached products
+        erply.getProducts()
+        assert m.call_count == 5
+
+    def test_response_cache_bulk_writes(self, m):
+        names = {'1': 'Old'}
+
+        def respond(request, context):
+            qs = parse_qs(request.text)
+            if 'requests' not in qs:
+                return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470473993,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"productID":1,"name":names['1']}]})
+            items = []
+            for r in json.loads(qs['requests'][0]):
+                names[str(r['productID'])] = r['name']
+                status = {'requestName': r['requestName'], 'requestID': r['requestID'], 'responseStatus': 'ok', 'errorCode': 0, 'recordsTotal': 1}
+                items.append({'status': status, 'records': [{'productID': r['productID']}]})
+            return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=respond)
+        erply = Erply(self._auth, cache=ErplyCache(ttls={'getProducts': 60}))
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        assert erply.getProducts().fetchone()['name'] == 'Old'
+        with erply.batch():
+            erply.saveProduct(productID=1, name='Batch')
+        # Writes sent in bulk invalidate cached products as well
+        assert erply.getProducts().fetchone()['name'] == 'Batch'
+
+        with erply.writer() as writer:
+            writer.saveProduct(productID=1, name='Writer')
+        assert erply.getProducts().fetchone()['name'] == 'Writer'
+
+    def test_response_cache_eviction(self, m):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        disk = ErplySQLiteCacheBackend(path, max_size=2)
+        self.addCleanup(disk.close)
+
+        for backend in (ErplyMemoryCacheBackend(max_size=2), disk):
+            cache = ErplyCache(ttls={'getWarehouses': 60}, backend=backend)
+            for n in range(3):
+                cache.set('getWarehouses', 'eng', {'pageNo': n}, {'n': n})
+            assert cache.get('getWarehouses', 'eng', {'pageNo': 0}) is None
+            assert cache.get('getWarehouses', 'eng', {'pageNo': 2}) == {'n': 2}
+            cache.invalidate('getWarehouses')
+            assert cache.get('getWarehouses', 'eng', {'pageNo': 2}) is None
+
+    def test_incremental_sync(self, m):
+        pages = {1: [{'productID': 1, 'name': 'A'}, {'productID': 2, 'name': 'B'}], 2: [{'productID': 3, 'name': 'C'}]}
+        failures = [2]
+
+        def products(request, context):
+            qs = parse_qs(request.text)
+            page = int(qs.get('pageNo', ['1'])[0])
+            if page in failures:
+                failures.remove(page)
+                context.status_code = 400
+                return ''
+            records = pages[page] if 'changedSince' not in qs else [{'productID': 2, 'name': 'B2'}]
+            total = 3 if 'changedSince' not in qs else 1
+            return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":total,"recordsInResponse":len(records)},"records":records})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=products)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        sync = ErplySync(self.erply, path, per_page=2)
+        self.addCleanup(sync.close)
+
+        # Crash while fetching second page
+        with self.assertRaises(ValueError):
+            sync.sync('getProducts')
+        assert sync.get('getProducts', 2) == {'productID': 2, 'name': 'B'}
+
+        # Resumed run only fetches the missing page
+        assert sync.sync('getProducts') == 1
+        assert parse_qs(m.request_history[-1].text)['pageNo'] == ['2']
+        assert len(list(sync.records('getProducts'))) == 3
+
+        # Next run only fetches changed records
+        assert sync.sync('getProducts') == 1
+        qs = parse_qs(m.request_history[-1].text)
+        assert qs['changedSince'] == ['1470506908']
+        assert sync.get('getProducts', 2)['name'] == 'B2'
+
+        # Interrupted run is started over when pages are requested differently
+        failures.append(2)
+        with self.assertRaises(ValueError):
+            sync.sync('getProducts', name='other')
+        calls = m.call_count
+        assert sync.sync('getProducts', name='other', warehouseID=1) == 3
+        assert 'pageNo' not in parse_qs(m.request_history[calls].text)
+
+    def test_bulk_pagination(self, m):
+        records = [{'id': n} for n in range(9)]
+
+        def page_response(params):
+            page = int(params.get('pageNo', 1)) - 1
+            size = int(params['recordsOnPage'])
+            chunk = records[page * size:page * size + size]
+            status = {"request":"getSalesDocuments","responseStatus":"ok","errorCode":0,"recordsTotal":len(records),"recordsInResponse":len(chunk)}
+            return status, chunk
+
+        def documents(request, context):
+            qs = parse_qs(request.text)
+            if 'requests' not in qs:
+                status, chunk = page_response(dict((k, v[0]) for k, v in qs.items()))
+                return json.dumps({'status': status, 'records': chunk})
+            items = []
+            # Pages are merged by requestID, not by position
+            for r in reversed(json.loads(qs['requests'][0])):
+                status, chunk = page_response(r)
+                status.update(requestName=r['requestName'], requestID=r['requestID'])
+                items.append({'status': status, 'records': chunk})
+            return json.dumps({'status': {'request': None, 'responseStatus': 'ok', 'errorCode': 0}, 'requests': items})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=documents)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+        self.erply.ERPLY_BULK_MAX = 3
+
+        r = self.erply.getSalesDocuments(recordsOnPage=2)
+        assert list(r.iter_records(bulk=True)) == records
+        # First page and two bulk requests for the remaining four pages
+        assert m.call_count == 3
+        assert [p['pageNo'] for p in json.loads(parse_qs(m.request_history[1].text)['requests'][0])] == [2, 3, 4]
+
+        r = self.erply.getSalesDocuments(recordsOnPage=2)
+        r.fetch_pages()
+        assert m.call_count == 6
+        assert [p['id'] for p in r[4]] == [8]
+
+    def test_resumable_pull(self, m):
+        records = [{'id': n} for n in range(5)]
+        failures = [2]
+
+        def documents(request, context):
+            qs = parse_qs(request.text)
+            page = int(qs.get('pageNo', ['1'])[0]) - 1
+            if page in failures:
+                failures.remove(page)
+                context.status_code = 400
+                return ''
+            chunk = records[page * 2:page * 2 + 2]
+            return json.dumps({"status":{"request":"getSalesDocuments","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":len(records),"recordsInResponse":len(chunk)},"records":chunk})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=documents)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, 'documents.ndjson')
+        pull = ErplyPull(self.erply, 'getSalesDocuments', path, per_page=2)
+        self.addCleanup(pull.reset)
+
+        # Crash while fetching third page, leaving partially written record
+        with self.assertRaises(ValueError):
+            pull.run()
+        assert pull.load_checkpoint()['page'] == 2
+        with open(path, 'ab') as f:
+            f.write(b'{"id": 4')
+
+        # Resumed pull only fetches the missing page
+        assert pull.run() == 5
+        assert m.call_count == 4
+        with open(path) as f:
+            assert [json.loads(line) for line in f] == records
+        assert pull.run() == 5
+        assert m.call_count == 4
+
+        # Changed dataset is detected when resuming
+        pull.reset()
+        failures.append(1)
+        with self.assertRaises(ValueError):
+            pull.run()
+        records.append({'id': 5})
+        with self.assertRaises(ErplyException):
+            pull.run()
+        pull.restart_on_change = True
+        assert pull.run() == 6
+        with open(path) as f:
+            assert [json.loads(line) for line in f] == records
+
+        # Checkpoint of other pull is not resumed
+        with self.assertRaises(ErplyException):
+            ErplyPull(self.erply, 'getSalesDocuments', path, per_page=3).run()
+
+        # Resumed CSV file keeps its header and columns
+        pull.reset()
+        pull = ErplyPull(self.erply, 'getSalesDocuments', path, per_page=2, format='csv')
+        failures.append(1)
+        with self.assertRaises(ValueError):
+            pull.run()
+        assert pull.run() == 6
+        with open(path, newline='') as f:
+            assert f.read() == 'id\r\n0\r\n1\r\n2\r\n3\r\n4\r\n5\r\n'
+
+    def test_compact_records(self, m):
+        def customers(request, context):
+            page = int(parse_qs(request.text).get('pageNo', ['1'])[0])
+            records = [{"id": page, "name": "Customer {}".format(page)}]
+            if page == 3:
+                records.append({"id": 30, "email": "foo@example.com"})
+            else:
+                records.append({"id": page * 10, "name": "Customer {}".format(page * 10)})
+            return json.dumps({"status":{"request":"getCustomers","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":8,"recordsInResponse":len(records)},"records":records})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=customers)
+        erply = Erply(self._auth, compact_records=True, max_pages=2)
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        r = erply.getCustomers(recordsOnPage=2)
+        # Pages with same fields share their schema
+        assert r[0]._index is r[1]._index
+
+        pages = r[1:3]
+        assert [len(page) for page in pages] == [2, 2]
+        assert isinstance(pages[1], ErplyRecordPage)
+        assert pages[1].keys == ('id', 'name', 'email')
+        assert pages[1][0] == {"id": 3, "name": "Customer 3"}
+        assert pages[1][1].get('name') is None
+        assert pages[1].column('email') == [None, 'foo@example.com']
+
+        # Only two most recent pages are kept
+        assert list(r.records) == [1, 2]
+        assert m.call_count == 3
+        assert [c['id'] for c in r.iter_records()] == [1, 10, 2, 20, 3, 30, 4, 40]
+
+    @mock.patch('erply_api._PageSizer.max_bytes', 3000)
+    def test_adaptive_page_size(self, m):
+        def products(request, context):
+            qs = parse_qs(request.text)
+            size = int(qs['recordsOnPage'][0])
+            start = (int(qs.get('pageNo', ['1'])[0]) - 1) * size
+            records = [{'productID': n, 'name': 'x' * 20} for n in range(start, min(start + size, 250))]
+            return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":250,"recordsInResponse":len(records)},"records":records})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=products)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+        self.erply.ERPLY_PAGE_SIZE_MAX = {'getProducts': 100}
+
+        r = self.erply.getProducts(recordsOnPage='auto')
+        assert parse_qs(m.request_history[0].text)['recordsOnPage'] == ['100']
+        assert r.per_page == 100 and r.pages == 3
+
+        # Oversized first response halves the request size, pages keep their size
+        assert [p['productID'] for p in r[1]] == list(range(100, 200))
+        assert [(q['recordsOnPage'], q['pageNo']) for q in map(parse_qs, (h.text for h in m.request_history[1:]))] == [
+            (['50'], ['3']), (['50'], ['4'])]
+        assert [p['productID'] for p in r.iter_records()] == list(range(250))
+
+    def test_server_page_size_limit(self, m):
+        def products(request, context):
+            qs = parse_qs(request.text)
+            size = min(int(qs['recordsOnPage'][0]), 100)
+            start = (int(qs.get('pageNo', ['1'])[0]) - 1) * size
+            records = [{'productID': n} for n in range(start, min(start + size, 250))]
+            return json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":250,"recordsInResponse":len(records)},"records":records})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=products)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        # Smaller first page than requested sets page size of the response
+        r = self.erply.getProducts(recordsOnPage=200)
+        assert r.per_page == 100 and r.pages == 3
+        assert [p['productID'] for p in r.iter_records()] == list(range(250))
+        assert m.call_count == 3
+
+        # Adaptive pagination starts with the lowered size
+        r = self.erply.getProducts(recordsOnPage='auto')
+        assert parse_qs(m.request_history[-1].text)['recordsOnPage'] == ['100']
+        assert len(list(r.iter_records())) == 250
+
+        # Short page in the middle of the result set can not be fixed up
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=json.dumps({"status":{"request":"getProducts","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":250,"recordsInResponse":50},"records":[{}] * 50}))
+        with self.assertRaises(ErplyException):
+            r.fetch_records(1)
+
+    def test_lazy_records(self, m):
+        _customers = json.dumps({"status":{"request":"getCustomers","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":2,"recordsInResponse":1},"records":[{"id":7}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_customers)
+
+        codec = mock.Mock(wraps=ErplyJSONCodec())
+        erply = Erply(self._auth, codec=codec, lazy_records=True)
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        r = erply.getCustomers(recordsOnPage=1)
+        erply.getCustomers(recordsOnPage=1, _page=1, _response=r)
+        assert r.total == 2
+        codec.loads.assert_not_called()
+
+        assert r[1] == [{"id": 7}]
+        assert codec.loads.call_count == 1
+
+    def test_instrumentation(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"generationTime":0.04,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]})
+        _sexp_response = json.dumps({"status":{"request":"getWarehouses","requestUnixTime":1470474000,"responseStatus":"error","errorCode":1054,"generationTime":0.003,"recordsTotal":0,"recordsInResponse":0}})
+        _ware_response = json.dumps({"status":{"request":"getWarehouses","requestUnixTime":1470473993,"responseStatus":"ok","errorCode":0,"generationTime":0.05,"recordsTotal":1,"recordsInResponse":1},"records":[{"warehouseID":"1"}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), [
+            {'text': _auth_response},
+            {'text': _sexp_response},
+            {'text': _auth_response},
+            {'text': _ware_response},
+        ])
+        stats = ErplyStats()
+        observer = mock.Mock()
+        erply = Erply(self._auth, observers=[stats, observer])
+
+        erply.getWarehouses()
+
+        events = [c[0][0] for c in observer.request.call_args_list]
+        assert [(e.request, e.error) for e in events] == [
+            ('verifyUser', None), ('getWarehouses', 1054), ('verifyUser', None), ('getWarehouses', None)]
+        assert events[-1].generation_time == 0.05
+        assert events[-1].bytes_received == len(_ware_response)
+        assert events[-1].bytes_sent > 0
+        observer.retry.assert_called_once_with('getWarehouses', 'reauth')
+
+        summary = stats.summary()
+        assert summary['getWarehouses']['count'] == 2
+        assert summary['getWarehouses']['errors'] == 1
+        assert summary['getWarehouses']['retries'] == 1
+        assert summary['verifyUser']['p50'] <= summary['verifyUser']['p99']
+
+        # Explicit bulk requests are reported with their size
+        _bulk = json.dumps({"status":{"request":"","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0},"requests":[
+            {"status":{"requestID":n,"responseStatus":"ok","errorCode":0},"records":[]} for n in (1, 2)]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_bulk)
+        bulk = ErplyBulkRequest(erply)
+        bulk.attach('getWarehouses')
+        bulk.attach('getWarehouses', warehouseID=1)
+        bulk()
+        event = observer.request.call_args[0][0]
+        assert (event.request, event.batch_size) == ('bulk', 2)
+        assert stats.summary()['bulk']['count'] == 1
+
+    def test_export(self, m):
+        pages = {
+            1: [{'id': 1, 'client': {'name': 'A'}, 'rows': [{'code': 'X', 'amount': 1}, {'code': 'Y', 'amount': 2}]}],
+            2: [{'id': 2, 'client': {'name': 'B'}, 'rows': []}],
+        }
+
+        def documents(request, context):
+            page = int(parse_qs(request.text).get('pageNo', ['1'])[0])
+            return json.dumps({"status":{"request":"getSalesDocuments","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":2,"recordsInResponse":1},"records":pages[page]})
+
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=documents)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        out = io.StringIO()
+        assert export(self.erply, 'getSalesDocuments', out, recordsOnPage=1) == 2
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == pages[1] + pages[2]
+
+        out = io.StringIO()
+        count = export(self.erply, 'getSalesDocuments', out, format='csv', flatten=True,
+                       explode='rows', fields=['id', 'client.name', 'rows.code'], recordsOnPage=1)
+        assert count == 3
+        assert out.getvalue().splitlines() == [
+            'id,client.name,rows.code', '1,A,X', '1,A,Y', '2,B,']
+
+    def test_fan_out(self, m):
+        _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600}]})
+        _elim_response = json.dumps({'status': {'requestUnixTime': 1470596233, 'responseStatus': 'error', 'request': 'getProductStock', 'errorCode': 1002, 'recordsTotal': 0}})
+
+        def stock(request, context):
+            qs = parse_qs(request.text)
+            if qs['request'] == ['verifyUser']:
+                return _auth_response
+            page = int(qs.get('pageNo', ['1'])[0])
+            return json.dumps({"status":{"request":"getProductStock","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":2,"recordsInResponse":1},"records":[{"productID":page}]})
+
+        m.post('https://a.erply.com/api/', text=stock)
+        m.post('https://b.erply.com/api/', text=stock)
+        m.post('https://c.erply.com/api/', text=_elim_response)
+        auths = [ErplyAuth(code, 'user', 'pass') for code in 'abc']
+
+        results = dict((r.code, r) for r in ErplyFanOut(max_workers=2).run(
+            auths, 'getProductStock', recordsOnPage=1, warehouseID=1))
+
+        assert results['a'].result == [{'productID': 1}, {'productID': 2}]
+        assert results['b'].ok
+        # Failure of one account does not abort the others
+        assert isinstance(results['c'].error, ErplyAPILimitException)
+
     def test_reauth_parameters(self, m):
         _auth_response = json.dumps({"status":{"request":"verifyUser","requestUnixTime":1470506907,"responseStatus":"ok","errorCode":0,"generationTime":0.046638011932373,"recordsTotal":1,"recordsInResponse":1},"records":[{"userID":"6","userName":"demo","employeeID":"4","employeeName":"Clara Smith","groupID":"7","groupName":"sales representatives","sessionKey":"jVCn2ee69668699820b799fc80bc8a678e235fa3b363","sessionLength":3600,"loginUrl":"https:\/\/demo.erply.com\/eng\/","berlinPOSVersion":"3.17.2","berlinPOSAssetsURL":"http:\/\/assets.erply.com\/berlin\/","epsiURL":"https:\/\/app.erply.com\/epsi\/EPSI.jnlp"}]})
         _serr_response = json.dumps({"status":{"request":"getProducts","requestUnixTime":1470474000,"responseStatus":"error","errorCode":1054,"generationTime":0.0036911964416504,"recordsTotal":0,"recordsInResponse":0}})
@@ -192,6 +1073,170 @@ class TestErplyIntegration(unittest.TestCase):
 
         assert m.call_count == 2
 
+    @mock.patch('erply_api.sleep', return_value=None)
+    def test_retry_transient_errors(self, m, time_sleep):
+        _customer_1 = json.dumps({"status":{"request":"getCustomers","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"id":7}]})
+        _save = json.dumps({"status":{"request":"saveProduct","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":1,"recordsInResponse":1},"records":[{"productID":1}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), [
+            {'status_code': 503, 'text': ''},
+            {'exc': requests.exceptions.ConnectionError},
+            {'text': _customer_1},
+            {'status_code': 502, 'text': ''},
+            {'text': _save},
+        ])
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        r = self.erply.getCustomers()
+        assert r[0] == [{'id': 7}]
+        assert m.call_count == 3
+        assert time_sleep.call_count == 2
+        assert all(call[0][0] <= 1.0 for call in time_sleep.call_args_list)
+
+        # Writes are not retried once request may have reached the server
+        with self.assertRaises(ValueError):
+            self.erply.saveProduct(name='A')
+        assert m.call_count == 4
+
+        # Bulk reads share the timeout and retries of single calls
+        _bulk = json.dumps({"status":{"request":"","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0},"requests":[
+            {"status":{"requestID":1,"responseStatus":"ok","errorCode":0},"records":[{"id":7}]}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), [
+            {'exc': requests.exceptions.ConnectTimeout},
+            {'text': _bulk},
+        ])
+        bulk = ErplyBulkRequest(self.erply)
+        bulk.attach('getCustomers')
+        r = bulk()
+        assert [page for page in r.records] == [[{'id': 7}]]
+        assert m.call_count == 6
+        assert m.request_history[-1].timeout == self.erply._request_timeout()
+
+        # Errors failing the same way again are not retried
+        url = 'https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE)
+        m.post(url, [{'exc': requests.exceptions.InvalidURL}, {'text': _customer_1}])
+        with self.assertRaises(requests.exceptions.InvalidURL):
+            self.erply.getCustomers()
+        assert m.call_count == 7
+
+        # Write is retried when connection was refused before sending it
+        refused = requests.exceptions.ConnectionError(MaxRetryError(None, url, NewConnectionError(None, 'refused')))
+        m.post(url, [{'exc': refused}, {'text': _save}])
+        assert self.erply.saveProduct(name='A')[0] == [{'productID': 1}]
+        assert m.call_count == 9
+
+    def test_deadline(self, m):
+        _customer_1 = json.dumps({"status":{"request":"getCustomers","requestUnixTime":1470506908,"responseStatus":"ok","errorCode":0,"recordsTotal":2,"recordsInResponse":1},"records":[{"id":7}]})
+        m.post('https://{}.erply.com/api/'.format(self.ERPLY_CUSTOMER_CODE), text=_customer_1)
+        self.erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        r = self.erply.getCustomers(recordsOnPage=1, _timeout=5, _deadline=0.05)
+        assert m.request_history[0].timeout <= 0.05
+        assert 'timeout' not in m.request_history[0].text
+
+        # Following pages share the deadline of the original call
+        sleep(0.06)
+        with self.assertRaises(ErplyTimeoutException):
+            r[1]
+        assert m.call_count == 1
+
+
+class FakeAsyncTransport(object):
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def post(self, url, data=None, headers=None, timeout=None):
+        self.requests.append(dict(data))
+        # Yield control so concurrent calls interleave
+        await asyncio.sleep(0)
+        return mock.Mock(status_code=200, content=json.dumps(self.responses.pop(0)).encode('utf-8'))
+
+
+class TestAsyncErply(unittest.TestCase):
+
+    _auth_response = {"status": {"request": "verifyUser", "requestUnixTime": 1470506907, "responseStatus": "ok", "errorCode": 0, "recordsTotal": 1, "recordsInResponse": 1}, "records": [{"sessionKey": "jVCn2ee69668699820b799fc80bc8a678e235fa3b363", "sessionLength": 3600}]}
+    _ware_response = {"status": {"request": "getWarehouses", "requestUnixTime": 1470473993, "responseStatus": "ok", "errorCode": 0, "recordsTotal": 3, "recordsInResponse": 3}, "records": [{"warehouseID": "1"}, {"warehouseID": "2"}, {"warehouseID": "3"}]}
+    _sexp_response = {"status": {"request": "getWarehouses", "requestUnixTime": 1470474000, "responseStatus": "error", "errorCode": 1054, "recordsTotal": 0, "recordsInResponse": 0}}
+
+    def setUp(self):
+        self._auth = ErplyAuth('eng', 'demo', 'demouser')
+
+    def test_concurrent_calls_authenticate_once(self):
+        transport = FakeAsyncTransport([self._auth_response] + [self._ware_response] * 3)
+        erply = AsyncErply(self._auth, transport=transport)
+
+        async def run():
+            return await asyncio.gather(*[erply.getWarehouses() for _ in range(3)])
+
+        responses = asyncio.run(run())
+        assert [r.total for r in responses] == [3, 3, 3]
+        assert [r['request'] for r in transport.requests].count('verifyUser') == 1
+
+        # Thread based helpers of the sync client are not inherited
+        for name in ('batch', 'writer', 'loader'):
+            assert not hasattr(erply, name)
+        assert not hasattr(responses[0], 'fetch_pages')
+
+    def test_reauth(self):
+        transport = FakeAsyncTransport([
+            self._auth_response, self._sexp_response,
+            self._auth_response, self._ware_response,
+        ])
+        erply = AsyncErply(self._auth, transport=transport)
+
+        r = asyncio.run(erply.getWarehouses(warehouseID=2))
+        assert r.total == 3
+        assert len(transport.requests) == 4
+        assert transport.requests[3]['warehouseID'] == 2
+
+    def test_session_refresh_in_background(self):
+        store = ErplySessionStore()
+        store.set('eng:demo', ('old', time() + 30, time() - 1))
+        transport = FakeAsyncTransport([self._auth_response])
+        erply = AsyncErply(self._auth, transport=transport, session_store=store)
+
+        async def run():
+            # Current key is used while new one is requested in the background
+            assert await erply.get_session() == 'old'
+            await erply._refresh_task
+            return await erply.get_session()
+
+        assert asyncio.run(run()) == self._auth_response['records'][0]['sessionKey']
+        assert store.get('eng:demo')[0] == self._auth_response['records'][0]['sessionKey']
+        assert len(transport.requests) == 1
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_transport_errors(self):
+        # Errors are raised as their `requests` counterparts
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{}/'.format(s.getsockname()[1])
+
+        async def post(transport):
+            try:
+                await transport.post(url, timeout=(1, 1))
+            finally:
+                await transport.close()
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            asyncio.run(post(AsyncErplyTransport()))
+        session = mock.Mock(post=mock.Mock(side_effect=asyncio.TimeoutError), close=mock.AsyncMock())
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            asyncio.run(post(AsyncErplyTransport(session=session)))
+        session.post.side_effect = aiohttp.ServerDisconnectedError()
+        with self.assertRaises(requests.exceptions.RequestException):
+            asyncio.run(post(AsyncErplyTransport(session=session)))
+
+    def test_hourly_limit_exception(self):
+        _elim_response = {'status': {'requestUnixTime': 1470596233, 'responseStatus': 'error', 'request': 'getCustomers', 'errorCode': 1002, 'recordsTotal': 0}}
+        erply = AsyncErply(self._auth, transport=FakeAsyncTransport([_elim_response]))
+        erply._key = 'jVCn2ee69668699820b799fc80bc8a678e235fa3b363'
+
+        with self.assertRaises(ErplyAPILimitException) as cm:
+            asyncio.run(erply.getCustomers())
+        self.assertEqual(cm.exception.server_time, datetime.fromtimestamp(1470596233))
+
 
 if __name__ == '__main__':
     unittest.main()